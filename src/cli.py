@@ -0,0 +1,143 @@
+# ------------------------------------------------------------------------------
+# File: cli.py
+# Description: headless command-line entry point for KriRAG (no streamlit)
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+# keep these at the top
+import dotenv
+
+dotenv.load_dotenv()
+
+# remaining imports...
+import argparse
+import json
+import os
+from datetime import datetime
+from typing import List
+
+from combine import collect_results, meta_summary
+from initialize import iter_records, list_documents, populate_collection
+from rag import (
+    BATCHING_MODES,
+    DOCUMENT_AGGREGATIONS,
+    MEMORY_SCOPES,
+    MEMORY_STRATEGIES,
+    PREFILTER_MODES,
+    PROMPT_LAYOUTS,
+    RETRIEVAL_MODES,
+    run_rag,
+)
+from utils.metrics import Metrics, format_summary, get_metrics, set_metrics
+from utils.progress import ConsoleCallback
+
+
+def read_queries(path: str) -> List[str]:
+    # one query per line
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run KriRAG on a case without the UI: ingest documents, run queries, write JSONL/CSV."
+    )
+    parser.add_argument("--data", required=True, help="a .txt file, a .zip of .txt files, or a folder")
+    parser.add_argument("--queries", required=True, help="text file with one query per line")
+    parser.add_argument("--collection", default=None, help="collection name (default: data file name)")
+    parser.add_argument("--lang", default="english", help="language for sentence segmentation")
+    parser.add_argument("--delete", action="store_true", help="delete previously computed data")
+    parser.add_argument("--ip", default="localhost", help="LLM server name or IP address, or a comma-separated list of host:port")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--top-n", type=int, default=10, help="sentences to match per query (-1: all documents)")
+    parser.add_argument("--top-k", type=int, default=None, help="documents to analyze per query, most relevant first")
+    parser.add_argument("--aggregation", choices=DOCUMENT_AGGREGATIONS, default="max", help="document score from its matching sentences")
+    parser.add_argument("--retrieval", choices=RETRIEVAL_MODES, default="hybrid", help="'hybrid' fuses dense and BM25 rankings")
+    parser.add_argument("--prefilter", choices=PREFILTER_MODES, default="none", help="cheap relevance screening before the full analysis")
+    parser.add_argument("--prefilter-threshold", type=float, default=None, help="skip batches scoring below (default: 1 for llm, 0.1 for reranker)")
+    parser.add_argument("--early-stop", action="store_true", help="stream the analysis and stop at a 0 score")
+    parser.add_argument("--prompt-layout", choices=PROMPT_LAYOUTS, default="default", help="'prefix' lets the server reuse the cached prompt prefix")
+    parser.add_argument("--ctx-len", type=int, default=8168)
+    parser.add_argument("--new-tokens", type=int, default=4096)
+    parser.add_argument("--n-parallel", type=int, default=1, help="max in-flight LLM requests (the server slots, summed over servers)")
+    parser.add_argument("--memory-scope", choices=MEMORY_SCOPES, default="query")
+    parser.add_argument("--memory-strategy", choices=MEMORY_STRATEGIES, default="rolling")
+    parser.add_argument("--memory-every", type=int, default=1)
+    parser.add_argument("--batching", choices=BATCHING_MODES, default="words")
+    parser.add_argument("--resume", default=None, help="output folder of an interrupted run")
+    parser.add_argument("--no-meta-summary", action="store_true", help="skip the meta-summary of queries")
+    parser.add_argument("--csv", default=None, help="combined CSV path (default: <run folder>/combined_results.csv)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    callback = ConsoleCallback()
+    start_time = datetime.now()
+    set_metrics(Metrics())
+
+    collection_name = args.collection
+    if collection_name is None:
+        collection_name = os.path.splitext(os.path.basename(os.path.normpath(args.data)))[0]
+    collection_name = collection_name.replace(" ", "-").lower()
+
+    # documents are streamed through segmentation and embedding
+    _, collection = populate_collection(
+        iter_records(args.data, lang=args.lang),
+        total_documents=len(list_documents(args.data)),
+        collection_name=collection_name,
+        delete=args.delete,
+        callback=callback,
+    )
+
+    rag_path = run_rag(
+        queries=read_queries(args.queries),
+        collection=collection,
+        ip_address=args.ip,
+        port=args.port,
+        lang="en",
+        top_n=args.top_n,
+        top_k=args.top_k,
+        aggregation=args.aggregation,
+        retrieval=args.retrieval,
+        prefilter=args.prefilter,
+        prefilter_threshold=args.prefilter_threshold,
+        early_stop=args.early_stop,
+        prompt_layout=args.prompt_layout,
+        llm_ctx_len=args.ctx_len,
+        new_tokens=args.new_tokens,
+        n_parallel=args.n_parallel,
+        memory_scope=args.memory_scope,
+        memory_strategy=args.memory_strategy,
+        memory_every=args.memory_every,
+        batching=args.batching,
+        resume=args.resume,
+        callback=callback,
+    )
+
+    if not args.no_meta_summary:
+        meta = meta_summary(
+            rag_path, ip_address=args.ip, port=args.port, n_parallel=args.n_parallel
+        )
+        with open(os.path.join(rag_path, "meta_summary.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        for meta_dict in meta:
+            print(f"Query: {meta_dict['query']}\n{meta_dict['summary']}")
+            print(f"References: {', '.join(map(str, meta_dict['references']))}\n")
+
+    csv_path = args.csv or os.path.join(rag_path, "combined_results.csv")
+    collect_results(rag_path).to_csv(csv_path, index=False)
+
+    print(format_summary(get_metrics().summary()))
+    get_metrics().close()
+    diff_sec = int((datetime.now() - start_time).total_seconds())
+    callback.on_info(f"Analysis complete in {diff_sec} seconds. Results: {rag_path}, CSV: {csv_path}")
+
+
+if __name__ == "__main__":
+    main()
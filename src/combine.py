@@ -1,57 +1,174 @@
 import json
 import os
 import re
-from typing import Any, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Tuple
 
-import pandas as pd
+from llm import get_llm_client, pred
+from utils.batch import TokenCounter, chunk_items, word_counts
+from utils.metrics import get_metrics, set_metrics
 
-from llm import pred
+if TYPE_CHECKING:
+    import pandas as pd
 
 MIN_TOKENS: int = 100  # min summary tokens
 MAX_TOKENS: int = 2000  # output tokens
+CHUNK_WORDS: int = 3000  # words of summaries per findings call, if the server does not report its context
+PROMPT_MARGIN_TOKENS: int = 64  # slack for tokenizer differences at the boundaries of the prompt
+MIN_CHUNK_TOKENS: int = 256  # smallest useful budget for the summaries of a findings call
 
 processing_prompt: str = (
     "You are an AI assisting a criminal investigation, analyzing case files. You follow strict logical and deductive reasoning, and will only present information for which you have a complete overview of. Avoid assumptions and uncertainty. Do not repeat yourself. You receive the following information: '{text}'. Assess the relevance of each document to the query '{query}' and write a highly detailed summary (including involved persons, objects, locations and other entities), based on the most relevant documents. Return a JSON object with the summary and references to the most relevant documents."
 )
 
 
-def process_case(case_jsonl_path: str, ip_address: str, port: int) -> Tuple[str, Dict[str, Any]]:
+def _chunk_budget(query: str, ip_address: str, port: int, chunk_words: int) -> Tuple[int, Callable]:
+    """
+    The budget for the summaries of a findings call, and how to measure them:
+    in tokens, the slot context minus the output and the prompt, when the server reports its context,
+    else in words (`chunk_words`).
+    """
+    client = get_llm_client(ip_address, port)
+    n_ctx = client.n_ctx()
+    if not n_ctx:
+        return chunk_words, word_counts
+    prompt_tokens = len(client.tokenize(processing_prompt.format(text="", query=query)))
+    budget = n_ctx - MAX_TOKENS - prompt_tokens - PROMPT_MARGIN_TOKENS
+    if budget < MIN_CHUNK_TOKENS:
+        raise ValueError(
+            f"Context length {n_ctx} leaves no room for summaries with max_tokens={MAX_TOKENS}"
+        )
+    return budget, TokenCounter(client.tokenize).count
+
+
+def _reduce_chunk(
+    chunk: List[str], query: str, ip_address: str, port: int
+) -> Dict[str, Any]:
+    instruction: str = processing_prompt.format(text="\n".join(chunk), query=query)
+    try:
+        output = pred(
+            instruction,
+            ip_address=ip_address,
+            port=port,
+            use_schema="findings", max_tokens=MAX_TOKENS, evaluate=True,
+            stage="llm:meta_summary",
+        )
+    except ValueError:
+        output = None
+    if not isinstance(output, dict) or "summary" not in output:
+        print(f"Error: no findings for a chunk of {len(chunk)} summaries")
+        return {}
+    return output
+
+
+def _format_findings(findings: Dict[str, Any]) -> str:
+    # references are carried into the next level, so the final summary can cite the documents
+    references = ", ".join(str(r) for r in findings.get("references", []))
+    return f"{findings['summary']} (references: {references})"
+
+
+def process_case(
+    case_jsonl_path: str,
+    ip_address: str,
+    port: int,
+    executor: ThreadPoolExecutor = None,
+    chunk_words: int = CHUNK_WORDS,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Findings for the query of a run file, reduced hierarchically:
+    the document summaries are grouped into chunks that fit the server context (or `chunk_words` words),
+    each chunk is reduced to findings (in parallel on `executor`),
+    and the findings are merged the same way until a single chunk is left.
+    """
     doc_findings: List[Dict[str, Any]] = []
     with open(case_jsonl_path, "r", encoding="utf-8") as f:
         doc_findings = [json.loads(x) for x in f.readlines()]
     print(f"Found {len(doc_findings)} answers.")
-    doc_df = pd.DataFrame(doc_findings)
-    doc_df = pd.concat(
-        [
-            doc_df.drop(["llm_output"], axis=1),
-            doc_df["llm_output"].apply(pd.Series),
-        ],
-        axis=1,
-    )
-    query: str = doc_df["query"][0]
+    if not doc_findings:
+        return "", {}
+    query: str = doc_findings[0]["query"]
     print(f"Processing documents for query: {query}")
-    summaries: List[str] = doc_df["summary"].unique().tolist()
-    text: str = "\n".join(summaries)
-    instruction: str = processing_prompt.format(text=text, query=query)
-    output: Dict[str, Any] = pred(
-        instruction,
-        ip_address=ip_address,
-        port=port,
-        use_schema="findings", max_tokens=MAX_TOKENS, evaluate=True
+
+    # unique summaries, prefixed by their document ID
+    items: List[str] = list(
+        dict.fromkeys(
+            f"[{record['id']}] {record['llm_output']['summary']}"
+            for record in doc_findings
+            if isinstance(record.get("llm_output"), dict) and record["llm_output"].get("summary")
+        )
     )
-    return query, output
+    if not items:
+        return query, {}
 
+    budget, count = _chunk_budget(query, ip_address, port, chunk_words)
+    level = 0
+    while True:
+        chunks = chunk_items(items, budget, count)
+        print(f"Level {level}: {len(items)} summaries in {len(chunks)} chunks")
+        if executor is not None and len(chunks) > 1:
+            outputs = list(
+                executor.map(lambda c: _reduce_chunk(c, query, ip_address, port), chunks)
+            )
+        else:
+            outputs = [_reduce_chunk(c, query, ip_address, port) for c in chunks]
+        if len(chunks) == 1:
+            return query, outputs[0]
+        items = [_format_findings(o) for o in outputs if o]
+        if not items:
+            return query, {}
+        level += 1
+
+
+def meta_summary(
+    case_path: str, ip_address: str, port: int, n_parallel: int = 1
+) -> List[Dict[str, Any]]:
+    """Meta-summaries of all queries of a run, processed concurrently with at most `n_parallel` LLM requests."""
+    files = sorted(f for f in os.listdir(case_path) if f.endswith(".jsonl"))  # e.g., not the checkpoint folder
+    # chunk reductions share a bounded pool, the queries only wait for them
+    metrics = get_metrics()
+    with metrics.stage("meta_summary", items=len(files)):
+        # the workers record into the metrics of the calling run
+        with ThreadPoolExecutor(
+            max_workers=max(1, n_parallel), initializer=set_metrics, initargs=(metrics,)
+        ) as executor, ThreadPoolExecutor(
+            max_workers=max(1, len(files)), initializer=set_metrics, initargs=(metrics,)
+        ) as queries:
+            results = list(
+                queries.map(
+                    lambda f: process_case(
+                        os.path.join(case_path, f),
+                        ip_address=ip_address,
+                        port=port,
+                        executor=executor,
+                    ),
+                    files,
+                )
+            )
 
-def meta_summary(case_path: str, ip_address: str, port: int) -> List[Dict[str, Any]]:
     metas: List[Dict[str, Any]] = []
-    for f in os.listdir(case_path):
-        full_path: str = os.path.join(case_path, f)
-        query, processed = process_case(full_path, ip_address=ip_address, port=port)
+    for query, processed in results:
         if "summary" in processed:
             metas.append(
                 {
                     "query": query,
                     "summary": processed["summary"],
+                    "references": processed.get("references", []),
                 }
             )
     return metas
+
+
+def collect_results(case_path: str) -> "pd.DataFrame":
+    """All records of a run, one row per analyzed batch (the `id` column holds the query file)."""
+    import pandas as pd
+
+    all_data: List[Dict[str, Any]] = []
+    for file in sorted(os.listdir(case_path)):
+        if file.endswith(".jsonl"):
+            file_path = os.path.join(case_path, file)
+            with open(file_path, "r") as f:
+                for line in f:
+                    data = json.loads(line)
+                    data["id"] = file
+                    all_data.append(data)
+    return pd.DataFrame(all_data)
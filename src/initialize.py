@@ -1,43 +1,210 @@
+import hashlib
+import io
+import multiprocessing
 import os
-import shutil
+import threading
+import time
 import zipfile
-from typing import Dict, List, Tuple
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, groupby, islice
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Tuple
 
 import nltk
-import pandas as pd
-import streamlit as st
-from chromadb import PersistentClient
-from chromadb.types import Collection
-from chromadb.utils.batch_utils import create_batches
-from sentence_transformers import SentenceTransformer
 
-from utils.chroma import get_client
+from utils.embeddings import EmbeddingCache, encode_bucketed, model_identity
+from utils.metrics import get_metrics, set_metrics
+from utils.progress import ProgressCallback
+
+if TYPE_CHECKING:
+    # chromadb, pandas and sentence_transformers are slow to import, they are loaded on first use
+    import pandas as pd
+    from chromadb import PersistentClient
+    from chromadb.types import Collection
+    from sentence_transformers import SentenceTransformer
 
 EMBEDDING_MODEL = "sbert"
 LANG = "english"
 
 valid_exts = [".txt", ".json", ".jsonl"]
 
-with st.spinner("Loading SentenceTransformer model..."):
-    embedding_model = SentenceTransformer(
-        EMBEDDING_MODEL,
-        backend="openvino",  # we optimize cpu-inference to reduce docker container image (w/ cuda drivers etc.)
-        local_files_only=True,
-    )
+# punkt models live under models/tokenizers/punkt_tab (see install.py)
+MODEL_HOME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+SEGMENT_WORKERS = os.cpu_count() or 1
+
+# embedding settings, tune for the host (e.g., EMBEDDING_THREADS to the number of physical cores)
+EMBEDDING_DEVICE = os.getenv("EMBEDDING_DEVICE", "cpu")
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", 0))  # 0: backend default
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+
+# sentence embeddings are cached on disk across collections, set EMBEDDING_CACHE_PATH="" to disable
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("cache", "embeddings"))
+
+# the model and its embedding cache are loaded once per process, on first use
+_embedding_model: "SentenceTransformer" = None
+_embedding_cache: EmbeddingCache = None
+_embedding_lock = threading.Lock()
+
+
+def get_embedding_model() -> "SentenceTransformer":
+    """The process-wide SentenceTransformer, loaded and warmed up on the first call."""
+    global _embedding_model, _embedding_cache
+    with _embedding_lock:
+        if _embedding_model is not None:
+            return _embedding_model
+
+        from sentence_transformers import SentenceTransformer
+
+        model_kwargs = {}
+        if EMBEDDING_THREADS > 0:
+            import torch
+
+            torch.set_num_threads(EMBEDDING_THREADS)
+            model_kwargs["ov_config"] = {"INFERENCE_NUM_THREADS": str(EMBEDDING_THREADS)}
+
+        print("Loading SentenceTransformer model...")
+        start = time.perf_counter()
+        model = SentenceTransformer(
+            EMBEDDING_MODEL,
+            backend="openvino",  # we optimize cpu-inference to reduce docker container image (w/ cuda drivers etc.)
+            device=EMBEDDING_DEVICE,
+            local_files_only=True,
+            model_kwargs=model_kwargs,
+        )
+        # the first inference compiles the model, pay for it here rather than on the first document
+        model.encode(["warm-up"])
+        print(f"Loaded SentenceTransformer model in {time.perf_counter() - start:.1f}s")
+
+        if EMBEDDING_CACHE_PATH:
+            dim = model.get_sentence_embedding_dimension()
+            _embedding_cache = EmbeddingCache(
+                EMBEDDING_CACHE_PATH, model_id=model_identity(EMBEDDING_MODEL, dim), dim=dim
+            )
+        _embedding_model = model
+        return _embedding_model
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """The embedding cache of the process-wide model, None if disabled."""
+    get_embedding_model()
+    return _embedding_cache
+
+
+def load_txt_from_folder(
+    folder_path: str, lang: str = LANG, workers: int = SEGMENT_WORKERS
+) -> "pd.DataFrame":
+    import pandas as pd
+
+    return pd.DataFrame(list(iter_records(folder_path, lang=lang, workers=workers)))
+
+
+def document_names(paths: List[str], source: str = "") -> List[str]:
+    """
+    Document names of .txt paths inside a folder or archive: the file name without the extension,
+    or, for file names found in several subfolders, the path below the folder shared by all files
+    (e.g., "a/report" and "b/report"). Raises ValueError for paths that occur twice.
+    """
+    names = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    collisions = {n for n, count in Counter(names).items() if count > 1}
+    if not collisions:
+        return names
+    shared = os.path.commonpath([os.path.dirname(p) for p in paths]) if len(paths) > 1 else ""
+    names = [
+        os.path.splitext(os.path.relpath(p, shared or "."))[0] if n in collisions else n
+        for p, n in zip(paths, names)
+    ]
+    duplicates = sorted(n for n, count in Counter(names).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"Duplicate documents in {source}: {', '.join(duplicates)}")
+    return names
 
 
-def load_txt_from_folder(folder_path: str, lang: str = LANG) -> pd.DataFrame:
+def _folder_paths(folder: str) -> List[str]:
     # walk all files in the directory!
-    parsed_data = []
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith(".txt"):
-                with open(os.path.join(root, file), "r", encoding="utf-8") as f:
-                    _doc = f.readlines()
-                    filename_no_ext = os.path.splitext(file)[0]
-                    parsed_data.extend(parse_document(_doc, lang, document_name=filename_no_ext))
+    return [
+        os.path.relpath(os.path.join(root, file), folder).replace(os.sep, "/")
+        for root, _, files in os.walk(folder)
+        for file in files
+        if file.endswith(".txt")
+    ]
+
+
+def _zip_members(z: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    members = []
+    for member in z.infolist():
+        filename = os.path.basename(member.filename)
+        if member.is_dir() or not filename.endswith(".txt"):
+            continue
+        if member.filename.startswith("__MACOSX/") or filename.startswith("._"):
+            continue  # macOS resource forks
+        members.append(member)
+    return members
+
+
+def list_documents(source) -> List[str]:
+    """Names of the documents in `source` (see iter_documents), from the file or archive listing only."""
+    name = source if isinstance(source, str) else source.name
+    ext = os.path.splitext(name)[1].lstrip(".").lower()
+    if isinstance(source, str) and os.path.isdir(source):
+        return document_names(_folder_paths(source), name)
+    if ext == "txt":
+        return [os.path.splitext(os.path.basename(name))[0]]
+    if ext == "zip":
+        if not isinstance(source, str):
+            source.seek(0)
+        with zipfile.ZipFile(source, "r") as z:
+            return document_names([m.filename for m in _zip_members(z)], name)
+    return []
+
+
+def iter_documents(source) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Yield (document name, lines) for every .txt document in a .txt file, a .zip of .txt files or a folder.
+    `source` is a path, or a file-like object with a `name` (e.g., a streamlit upload).
+    Zip members are read one by one from the archive, nothing is extracted to disk.
+    Documents are named by their file name, see document_names for files with the same name.
+    """
+    name = source if isinstance(source, str) else source.name
+    ext = os.path.splitext(name)[1].lstrip(".").lower()
+    if not isinstance(source, str):
+        source.seek(0)  # uploads may have been read before
+
+    if isinstance(source, str) and os.path.isdir(source):
+        paths = _folder_paths(source)
+        for path, document_name in zip(paths, document_names(paths, name)):
+            with open(os.path.join(source, path), "r", encoding="utf-8") as f:
+                yield document_name, f.readlines()
+
+    elif ext == "txt":
+        if isinstance(source, str):
+            with open(source, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        else:
+            lines = source.read().decode("utf-8").splitlines(keepends=True)
+        print(f"Loaded single document with {len(lines)} paragraphs.")
+        yield os.path.splitext(os.path.basename(name))[0], lines
 
-    return pd.DataFrame(parsed_data)
+    elif ext == "zip":
+        with zipfile.ZipFile(source, "r") as z:
+            members = _zip_members(z)
+            # names are checked before anything is read
+            names = document_names([m.filename for m in members], name)
+            for member, document_name in zip(members, names):
+                with z.open(member) as f:
+                    lines = io.TextIOWrapper(f, encoding="utf-8").readlines()
+                yield document_name, lines
+
+
+def iter_records(
+    source,
+    lang: str = LANG,
+    workers: int = SEGMENT_WORKERS,
+    chunk_docs: int = 64,
+) -> Iterator[Dict[str, any]]:
+    """Stream the id/page_id/sent_id/text records of all documents in `source`, see iter_documents."""
+    return segment_documents(
+        iter_documents(source), lang=lang, workers=workers, chunk_docs=chunk_docs
+    )
 
 
 def parse_document(
@@ -45,13 +212,16 @@ def parse_document(
     lang: str = LANG,
     strip_newlines: bool = True,
     document_name: str = "",
+    sentencize: Callable[[str], List[str]] = None,  # defaults to nltk.sent_tokenize in `lang`
 ) -> List[str]:
     if strip_newlines:
         print(f"Stripping newlines from {len(docs)} documents.")
         docs = [d.replace("\n", "") for d in docs]
 
-    def sentencize(text):
-        return nltk.sent_tokenize(text, language=lang)
+    if sentencize is None:
+
+        def sentencize(text):
+            return nltk.sent_tokenize(text, language=lang)
 
     parsed_data = []
     sentences = []
@@ -75,97 +245,303 @@ def parse_document(
     return parsed_data
 
 
-@st.cache_data
-def load_and_cache_documents(uploaded_file, lang: str):
-    print(f"Loading: {uploaded_file.name} with language: {lang}")
-    ext = uploaded_file.name.split(".")[-1] if uploaded_file else None
-    filename = uploaded_file.name.split(".")[0] if uploaded_file else None
-    df = pd.DataFrame()
-    if ext == "txt":
-        uploaded_file = uploaded_file.read().decode("utf-8")
-        print(f"Loaded single document with {len(uploaded_file)} paragraphs.")
+# the punkt tokenizer of a segmentation worker process, loaded once per worker
+_worker_tokenizer = None
 
-        df = pd.DataFrame(parse_document(uploaded_file, lang=lang, document_name=filename))
 
-    elif ext == "zip":
-        with zipfile.ZipFile(uploaded_file, "r") as z:
-            # remove the temp folder if it exists
-            if os.path.exists("temp"):
-                shutil.rmtree("temp", ignore_errors=True)
-            z.extractall("temp")
-            df = load_txt_from_folder("temp")
-
-    if df.empty:
+def _init_segment_worker(lang: str):
+    global _worker_tokenizer
+    from nltk.tokenize.punkt import PunktTokenizer
+
+    if MODEL_HOME not in nltk.data.path:
+        nltk.data.path.insert(0, MODEL_HOME)
+    _worker_tokenizer = PunktTokenizer(lang)
+
+
+def _segment_document(document: Tuple[str, List[str]]) -> List[dict]:
+    document_name, lines = document
+    return parse_document(
+        lines,
+        document_name=document_name,
+        sentencize=_worker_tokenizer.tokenize,
+    )
+
+
+def document_hash(lines: List[str], lang: str = LANG) -> str:
+    # the language is part of the hash, as it changes the sentences
+    content = lang + "\n" + "".join(lines)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def segment_documents(
+    documents: Iterable[Tuple[str, List[str]]],
+    lang: str = LANG,
+    workers: int = SEGMENT_WORKERS,
+    chunk_docs: int = 64,
+) -> Iterator[Dict[str, any]]:
+    """
+    Sentencize (document name, lines) pairs in a process pool, `chunk_docs` documents at a time.
+    Records are yielded in the order of `documents`, same as parsing them one by one,
+    and at most one chunk of documents is held in memory.
+    Each record also holds the content hash of its document.
+    """
+    documents = iter(documents)
+    chunk = list(islice(documents, chunk_docs))
+    if workers <= 1 or len(chunk) < 2:
+        for document_name, lines in chain(chunk, documents):
+            doc_hash = document_hash(lines, lang)
+            for record in parse_document(lines, lang, document_name=document_name):
+                record["hash"] = doc_hash
+                yield record
+        return
+
+    workers = min(workers, len(chunk))
+    # forking a process that already runs threads (streamlit, the embedding warm-up) can deadlock the child
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_segment_worker,
+        initargs=(lang,),
+        mp_context=multiprocessing.get_context(start_method),
+    ) as executor:
+        while chunk:
+            # a few work units per worker balances uneven document lengths
+            chunksize = max(1, len(chunk) // (workers * 4))
+            results = executor.map(_segment_document, chunk, chunksize=chunksize)
+            for (_, lines), records in zip(chunk, results):
+                doc_hash = document_hash(lines, lang)
+                for record in records:
+                    record["hash"] = doc_hash
+                    yield record
+            chunk = list(islice(documents, chunk_docs))
+
+
+def describe_documents(source, lang: str = LANG, workers: int = SEGMENT_WORKERS) -> Dict[str, int]:
+    """Document, paragraph and sentence counts of `source`, streamed without keeping the records."""
+    name = source if isinstance(source, str) else source.name
+    print(f"Loading: {name} with language: {lang}")
+    documents = set()
+    pages = set()
+    num_sents = 0
+    for row in iter_records(source, lang=lang, workers=workers):
+        documents.add(row["id"])
+        pages.add(row["page_id"])
+        num_sents += 1
+
+    if num_sents == 0:
         raise ValueError("No data found in the uploaded file.")
 
-    print(f"Loaded {len(df)} documents.")
-    # columns: id/page_id/sent_id/text
-    num_docs = df["id"].nunique()
-    num_pages = df["page_id"].nunique()
-    num_sents = df.shape[0]
-    st.info(f"Found {num_docs} documents, {num_pages} paragraphs, and {num_sents} sentences")
+    print(f"Loaded {num_sents} sentences.")
     return {
-        "data": df.to_dict(orient="records"),
-        "num_docs": num_docs,
-        "num_pages": num_pages,
+        "num_docs": len(documents),
+        "num_pages": len(pages),
         "num_sents": num_sents,
     }
 
 
-def populate_collection(
+def _embed_records(
     data: List[Dict[str, any]],
+    BATCH_SIZE: int,
+    callback: ProgressCallback,
+) -> Dict[str, any]:
+    """Ids, embeddings, metadata and documents of records, ready for `add_in_batches`."""
+    import pandas as pd
+
+    embedding_model = get_embedding_model()
+    embedding_cache = get_embedding_cache()
+    df = pd.DataFrame(data)
+    documents = df["text"].tolist()
+    # a stable reference key for each sentence: sent_id is unique within a document
+    ids = (
+        df["id"] + "-" + df["page_id"].astype(str) + "-" + df["sent_id"].astype(str)
+    ).tolist()
+    document_meta = (
+        df[["id", "sent_id", "page_id", "hash"]]
+        .rename(columns={"id": "document"})
+        .to_dict(orient="records")
+    )
+
+    def encode_batch(texts: List[str]):
+        return embedding_model.encode(texts, batch_size=BATCH_SIZE)
+
+    def encode(texts: List[str]):
+        # similar lengths per batch, little padding
+        return encode_bucketed(
+            texts,
+            encode_batch,
+            callback=lambda done, total: callback.on_progress(
+                "Computing embeddings...", done, total
+            ),
+        )
+
+    start = time.perf_counter()
+    # embeddings stay a contiguous float32 matrix, chroma accepts numpy arrays
+    if embedding_cache is not None:
+        # duplicate and previously seen sentences are not embedded again
+        embeddings = embedding_cache.encode(documents, encode)
+    else:
+        embeddings = encode(documents)
+    elapsed = time.perf_counter() - start
+    get_metrics().record("embedding", elapsed, items=len(documents))
+    print(
+        f"Embedded {len(documents)} sentences in {elapsed:.1f}s ({len(documents) / max(elapsed, 1e-9):.0f} sentences/s)"
+    )
+
+    return dict(
+        ids=ids,
+        embeddings=embeddings,
+        metadatas=document_meta,
+        documents=documents,
+    )
+
+
+def populate_collection(
+    data: Iterable[Dict[str, any]],
     collection_name: str,
     delete=False,
-    BATCH_SIZE=32,
-) -> Tuple[PersistentClient, Collection]:
+    BATCH_SIZE=EMBEDDING_BATCH_SIZE,
+    callback: ProgressCallback = None,
+    chunk_size: int = 4096,  # records embedded and added at a time
+    total: int = None,  # number of records, if known, for progress
+    total_documents: int = None,  # else the number of documents, if known (see list_documents)
+) -> Tuple["PersistentClient", "Collection"]:
+    """
+    Synchronize the collection with id/page_id/sent_id/text/hash records (see iter_records).
+    Only new and changed documents (by content hash) are embedded, unchanged documents are skipped,
+    and documents no longer in `data` are removed.
+    `data` may be a stream; it is consumed in chunks of `chunk_size` records,
+    so memory is bounded by a chunk rather than the corpus.
+    Each chunk is added to chroma in the background while the next one is embedded.
+    """
+    from utils.chroma import (
+        add_in_batches,
+        build_document_index,
+        get_client,
+        read_document_index,
+        write_document_index,
+    )
+    from utils.bm25 import open_bm25_index
+    from utils.store import DocumentStore
+
+    if callback is None:
+        callback = ProgressCallback()
+    embedding_model = get_embedding_model()
+    embedding_cache = get_embedding_cache()
     client, collection = get_client(
         persist=True,  # persist: store to disk (under the `chroma` folder)
         delete=delete,  # WARNING: enable ONLY if doing changes to the data
         embedding_model=embedding_model,
         collection_name=collection_name,
+        embedding_cache=embedding_cache,
     )
+
+    index: Dict[str, dict] = {}
+    if collection.count() > 0:
+        # collections without an index get one built from their metadata (without hashes)
+        index = read_document_index(collection) or DocumentStore(collection).index()
+
+    # the lexical (BM25) index follows the collection, document by document
+    lexical = open_bm25_index(collection_name)
     if collection.count() == 0:
-        document_meta = []
-        meta_text = "Adding metadata..."
-        meta_bar = st.progress(0, text=meta_text)
-        for percent_complete, row in enumerate(data):
-            print(f"Adding metadata for document: {row['id']}")
-            document_meta.append(
-                {
-                    "document": row["id"],
-                    "sent_id": row["sent_id"],
-                    "page_id": row["page_id"],
-                }
-            )
-            current_perc = (percent_complete + 1) / len(data)
-            current_perc = min(current_perc, 1.0)
-            meta_bar.progress(current_perc)
-        meta_bar.empty()
-
-        documents = [d["text"] for d in data]
-
-        with st.spinner("Computing embeddings..."):
-            embeddings = embedding_model.encode(
-                documents,
-                show_progress_bar=True,
-                batch_size=BATCH_SIZE,
-            ).tolist()
-
-        # a reference key for each document
-        ids = []
-        for d_id, d in enumerate(data):
-            ids.append(f"{d_id}-{d['id']}-{d['page_id']}-{d['sent_id']}")
-
-        batches = create_batches(
-            api=client,
-            ids=ids,
-            embeddings=embeddings,
-            metadatas=document_meta,
-            documents=documents,
+        lexical.clear()  # left over from a deleted collection
+    lexical_documents = lexical.documents()
+
+    seen = set()
+    counts = {"unchanged": 0, "added": 0, "updated": 0, "removed": 0}
+    pending: List[Dict[str, any]] = []
+    n_records = 0
+    n_paragraphs = 0
+    n_embedded = 0
+    start = time.perf_counter()
+
+    # a single writer: inserts keep their order, and at most one embedded chunk waits
+    writer = ThreadPoolExecutor(max_workers=1, initializer=set_metrics, initargs=(get_metrics(),))
+    inserting = None
+
+    def insert(batch: Dict[str, any]):
+        with get_metrics().stage("chroma_insert", items=len(batch["ids"])):
+            add_in_batches(client, collection, **batch)
+
+    def flush(rows: List[Dict[str, any]]):
+        nonlocal inserting
+        batch = _embed_records(rows, BATCH_SIZE, callback)
+        if inserting is not None:
+            inserting.result()
+        inserting = writer.submit(insert, batch)
+
+    # records arrive grouped by document, reading and segmenting them is timed as they are consumed
+    data = get_metrics().timed_iter("segmentation", data)
+    for document, rows in groupby(data, key=lambda row: row["id"]):
+        rows = list(rows)
+        if document in seen:
+            # would delete or re-add rows of this pass, and collide on ids
+            raise ValueError(f"Document {document} appears twice in the data, document names must be unique")
+        n_records += len(rows)
+        n_paragraphs += len({row["page_id"] for row in rows})
+        seen.add(document)
+        if total:
+            callback.on_progress("Embedding sentences...", n_records, total)
+        elif total_documents:
+            callback.on_progress("Embedding sentences...", len(seen), total_documents)
+        previous = index.get(document)
+        if previous is not None and previous.get("hash") == rows[0]["hash"]:
+            counts["unchanged"] += 1
+            if document not in lexical_documents:
+                # collections populated before the lexical index existed
+                lexical.add(rows)
+            continue
+
+        if previous is not None:
+            collection.delete(where={"document": document})
+            lexical.delete([document])
+            counts["updated"] += 1
+        else:
+            counts["added"] += 1
+        lexical.add(rows)
+        index[document] = build_document_index(rows)[document]
+        index[document]["hash"] = rows[0]["hash"]
+
+        pending.extend(rows)
+        n_embedded += len(rows)
+        if len(pending) >= chunk_size:
+            flush(pending)
+            pending = []
+
+    try:
+        if pending:
+            flush(pending)
+        if inserting is not None:
+            inserting.result()
+    finally:
+        writer.shutdown(wait=True)
+    callback.on_progress("Embedding sentences...", n_records, n_records)
+    elapsed = time.perf_counter() - start
+    get_metrics().record("ingest", elapsed, items=n_records)
+    if n_embedded:
+        callback.on_info(
+            f"Embedded and stored {n_embedded} sentences in {elapsed:.1f}s ({n_embedded / elapsed:.0f} sentences/s)"
         )
 
-        # i: index, e: embedding, m: metadata, d: document
-        for i, e, m, d in batches:
-            collection.add(i, e, m, d)
+    removed = [d for d in index if d not in seen]
+    if removed:
+        collection.delete(where={"document": {"$in": removed}})
+        lexical.delete(removed)
+        for document in removed:
+            del index[document]
+        counts["removed"] = len(removed)
+
+    if counts["added"] or counts["updated"] or counts["removed"]:
+        # lightweight document index, saves scanning the collection for document names
+        write_document_index(collection, index)
+    callback.on_info(
+        f"Ingested {len(seen)} documents, {n_paragraphs} paragraphs and {n_records} sentences"
+    )
+    callback.on_info(
+        f"Documents: {counts['added']} added, {counts['updated']} updated, "
+        f"{counts['removed']} removed, {counts['unchanged']} unchanged"
+    )
+    if embedding_cache is not None:
+        print(f"Embedding cache: {embedding_cache.stats()}")
+    lexical.close()
 
     return client, collection
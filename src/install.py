@@ -26,3 +26,13 @@ else:
     model_home = "models"
     nltk.download("punkt", download_dir=model_home)
     nltk.download("punkt_tab", download_dir=model_home)
+
+# optional cross-encoder for the relevance pre-filter, e.g., RERANKER_SOURCE=BAAI/bge-reranker-v2-m3
+RERANKER_SOURCE = os.getenv("RERANKER_SOURCE")
+if RERANKER_SOURCE:
+    if os.path.exists("reranker"):
+        print("Reranker already saved.")
+    else:
+        from sentence_transformers import CrossEncoder
+
+        CrossEncoder(RERANKER_SOURCE).save_pretrained("reranker")
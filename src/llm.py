@@ -10,18 +10,51 @@
 # ------------------------------------------------------------------------------
 
 import json
+import os
 import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.cache import LLMCache
+from utils.jsonstream import IncrementalJSONParser, parse_json
+from utils.metrics import get_metrics
 
 question_and_reason_prompt = {
     "en": "You are an AI assisting a criminal investigation, analyzing case files for knowledge discoveries. You follow strict logical and deductive reasoning, and will only present information for which you have a complete overview of. Do not make assumptions, or add any superfluous information. {extra}You receive a new document with ID {doc_id}: '{text}'. Investigate document {doc_id} grounded in the QUERY: '{query}'. Generate a JSON object with 1) questions: a list of investigative questions (based on e.g., objects, actions, events, entities) that are directly related to the QUERY in {doc_id}. 2) reason: discuss whether document {doc_id} answers the QUERY. 3) score: if the document is 0 irrelevant, 1 somewhat relevant, 2 relevant, or 3 extremely relevant. 4) a summary of vital details uncovered in {doc_id}.",
 }
+# the same instructions with the static text first, then the query, the memory and the document:
+# consecutive calls share the longest possible prefix, which llama.cpp reuses from its KV cache (cache_prompt)
+question_and_reason_prompt_prefix = {
+    "en": "You are an AI assisting a criminal investigation, analyzing case files for knowledge discoveries. You follow strict logical and deductive reasoning, and will only present information for which you have a complete overview of. Do not make assumptions, or add any superfluous information. You receive a QUERY and a new document. Investigate the document grounded in the QUERY. Generate a JSON object with 1) questions: a list of investigative questions (based on e.g., objects, actions, events, entities) that are directly related to the QUERY in the document. 2) reason: discuss whether the document answers the QUERY. 3) score: if the document is 0 irrelevant, 1 somewhat relevant, 2 relevant, or 3 extremely relevant. 4) a summary of vital details uncovered in the document, referencing its ID.\nQUERY: '{query}'.\n{extra}Document with ID {doc_id}: '{text}'",
+}
+# "default": the original layout, "prefix": cache-friendly layout
+question_and_reason_prompts = {
+    "default": question_and_reason_prompt,
+    "prefix": question_and_reason_prompt_prefix,
+}
+relevance_prompt = {
+    "en": "You are an AI assisting a criminal investigation, screening case files. You receive a document with ID {doc_id}: '{text}'. Rate how relevant document {doc_id} is to the QUERY: '{query}'. Generate a JSON object with score: 0 irrelevant, 1 somewhat relevant, 2 relevant, or 3 extremely relevant.",
+}
 memory_prompt = "You are an AI assisting a criminal investigation, analyzing case files. You follow abductive reasoning and logic. Do not make assumptions, or add any superfluous information. From the following data:\n{previous_information}, create a summary of vital information related to the query: '{query}'. Make sure to reference the ID '{DOC_ID}' for your findings, and keep all previous document references."
 
 
 headers = {"Content-Type": "application/json"}
 
+CONNECT_TIMEOUT: float = 5.0  # seconds to establish a connection
+READ_TIMEOUT: float = 600.0  # seconds to wait for a (long) generation
+MAX_RETRIES: int = 3  # on 5xx responses and connection resets
+BACKOFF_FACTOR: float = 0.5  # 0.5s, 1s, 2s, ...
+HEALTH_INTERVAL: float = 5.0  # seconds between health checks of pooled servers
+
+# deterministic (temperature 0) responses are cached on disk, set LLM_CACHE_PATH="" to disable
+LLM_CACHE_PATH: str = os.getenv("LLM_CACHE_PATH", os.path.join("cache", "llm.sqlite"))
+LLM_CACHE_SIZE_MB: float = float(os.getenv("LLM_CACHE_SIZE_MB", 512))
+
 schema = {
     "type": "object",
     "properties": {
@@ -67,13 +100,466 @@ schema_findings = {
 }
 
 
+schema_score = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "integer", "enum": [0, 1, 2, 3]},
+    },
+    "required": ["score"],
+}
+
+
 schemas = {
     "default": schema,
     "summary": schema_summ,
     "findings": schema_findings,
+    "score": schema_score,
 }
 
 
+def _cache_key(client: "Union[LLMClient, EndpointPool]", data: dict) -> Optional[str]:
+    """
+    Cache key of a request, None if it is not cached: without a cache, when sampling,
+    or while the served model cannot be identified (looked up again on the next call).
+    """
+    if client.cache is None or data.get("temperature", 1) != 0:
+        return None
+    model = client.model_id()
+    if model is None:
+        return None
+    return LLMCache.make_key(model, data)
+
+
+class LLMClient:
+    """
+    Reusable client for a single llama.cpp server.
+    Holds a pooled keep-alive session, so consecutive calls reuse the same
+    TCP connections, and retries 5xx responses and connection resets with backoff.
+    With a cache, deterministic completions are served from disk when seen before.
+    """
+
+    def __init__(
+        self,
+        ip_address: str,
+        port: int,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
+        backoff_factor: float = BACKOFF_FACTOR,
+        pool_size: int = 32,  # should cover the number of parallel requests
+        cache: LLMCache = None,
+    ):
+        self.base_url = f"http://{ip_address}:{port}"
+        self.cache = cache
+        self._props: Optional[dict] = None
+        self._model_id: Optional[str] = None
+        self.timeout: Tuple[float, float] = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),  # POST is not retried by default
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=1, pool_maxsize=pool_size
+        )
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, endpoint: str) -> dict:
+        response = self.session.get(f"{self.base_url}/{endpoint}", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, endpoint: str, data: dict) -> dict:
+        response = self.session.post(
+            f"{self.base_url}/{endpoint}",
+            data=json.dumps(data),
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def props(self) -> dict:
+        """Server properties (model, slot context length, ...), fetched once."""
+        if self._props is None:
+            self._props = self.get("props")
+        return self._props
+
+    def n_ctx(self) -> Optional[int]:
+        """Context length of a single server slot, if reported."""
+        try:
+            return self.props().get("default_generation_settings", {}).get("n_ctx")
+        except requests.RequestException:
+            return None
+
+    def tokenize(self, text: str, with_pieces: bool = False) -> List:
+        """Token ids, or with_pieces, {"id", "piece"} dicts (the piece is a string, or bytes if not valid UTF-8)."""
+        return self.post("tokenize", {"content": text, "with_pieces": with_pieces})["tokens"]
+
+    def n_slots(self) -> Optional[int]:
+        """Number of server slots (llama.cpp -np), if reported."""
+        try:
+            return self.props().get("total_slots")
+        except requests.RequestException:
+            return None
+
+    def model_id(self) -> Optional[str]:
+        """Identity of the served model, part of the cache key. None if the server does not report it (yet)."""
+        if self._model_id is None:
+            try:
+                props = self.props()
+            except requests.RequestException:
+                return None
+            self._model_id = props.get("model_path") or props.get(
+                "default_generation_settings", {}
+            ).get("model")
+        return self._model_id
+
+    def completion(self, data: dict) -> dict:
+        """The server response, with "cached": True if it was served from the cache."""
+        key = _cache_key(self, data)
+        if key is None:
+            return self.post("completion", data)
+
+        response = self.cache.get(key)
+        if response is not None:
+            return {**response, "cached": True}
+        response = self.post("completion", data)
+        self.cache.set(key, response)
+        return response
+
+    def stream_completion(self, data: dict, info: dict = None) -> Iterator[str]:
+        """
+        Generated text of a streamed (server-sent events) completion, chunk by chunk.
+        Closing the generator early closes the connection, and the server stops generating.
+        Only completions that ran to the end are cached.
+        `info` receives the "timings" of the completion and whether it was "cached".
+        """
+        key = _cache_key(self, data)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                if info is not None:
+                    info.update(cached=True, timings=cached.get("timings"))
+                yield cached["content"]
+                return
+
+        response = self.session.post(
+            f"{self.base_url}/completion",
+            data=json.dumps({**data, "stream": True}),
+            timeout=self.timeout,
+            stream=True,
+        )
+        try:
+            response.raise_for_status()
+            response.encoding = "utf-8"
+            content = []
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: ") :])
+                if event.get("content"):
+                    content.append(event["content"])
+                    yield event["content"]
+                if event.get("stop"):
+                    if info is not None:
+                        info["timings"] = event.get("timings")
+                    break
+            if key is not None:
+                self.cache.set(
+                    key, {"content": "".join(content), "timings": (info or {}).get("timings")}
+                )
+        finally:
+            response.close()
+
+    def close(self):
+        self.session.close()
+
+
+class _Endpoint:
+    """State of a server in an EndpointPool."""
+
+    def __init__(self, client: LLMClient):
+        self.client = client
+        self.healthy = True  # until the first poll says otherwise
+        self.n_slots: Optional[int] = None
+        self.busy = 0  # slots processing, as reported by the server
+        self.inflight = 0  # requests sent from this process
+
+    def load(self) -> float:
+        return max(self.busy, self.inflight) / max(self.n_slots or 1, 1)
+
+
+class EndpointPool:
+    """
+    Spreads requests over several llama.cpp servers serving the same model, with the interface of LLMClient.
+    A background thread polls /health and /slots every `health_interval` seconds. Each request goes to
+    the least-loaded healthy server, and to the next one if a server fails (connection errors, 5xx).
+    Slots (id_slot) are numbered across servers: server 0 has slots 0..n0-1, server 1 the next n1, and so on.
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Tuple[str, int]],
+        health_interval: float = HEALTH_INTERVAL,
+        cache: LLMCache = None,
+        **kwargs,  # passed to the LLMClient of each server
+    ):
+        if not endpoints:
+            raise ValueError("EndpointPool needs at least one server")
+        self.cache = cache
+        self.health_interval = health_interval
+        # the pool caches responses, not the clients of each server
+        self.endpoints = [_Endpoint(LLMClient(ip, port, **kwargs)) for ip, port in endpoints]
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        # polls are not retried, a server that does not answer is unhealthy until the next poll
+        self._poll_session = requests.Session()
+        self.poll()
+        self._poller = threading.Thread(target=self._poll_loop, daemon=True)
+        self._poller.start()
+
+    def poll(self):
+        for endpoint in self.endpoints:
+            base_url = endpoint.client.base_url
+            try:
+                response = self._poll_session.get(f"{base_url}/health", timeout=(CONNECT_TIMEOUT, 5))
+                healthy = response.status_code == 200
+            except requests.RequestException:
+                healthy = False
+            busy, n_slots = endpoint.busy, endpoint.n_slots
+            if healthy:
+                try:
+                    response = self._poll_session.get(f"{base_url}/slots", timeout=(CONNECT_TIMEOUT, 5))
+                    if response.status_code == 200:
+                        slots = response.json()
+                        n_slots = len(slots)
+                        # "is_processing" in recent llama.cpp versions, "state" (1: processing) before
+                        busy = sum(
+                            1 for s in slots if s.get("is_processing", s.get("state", 0) != 0)
+                        )
+                    elif n_slots is None:
+                        n_slots = endpoint.client.n_slots()  # slots endpoint disabled (--no-slots)
+                except (requests.RequestException, ValueError):
+                    pass
+            with self.lock:
+                endpoint.healthy = healthy
+                endpoint.busy = busy
+                endpoint.n_slots = n_slots
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.health_interval):
+            self.poll()
+
+    def _acquire(self, id_slot: Optional[int], tried: set) -> Tuple[Optional[_Endpoint], Optional[int]]:
+        """The server for a request and its local slot, marked as in flight."""
+        with self.lock:
+            candidates = [e for e in self.endpoints if id(e) not in tried]
+            if not candidates:
+                return None, None
+            endpoint, local_slot = None, None
+            if id_slot is not None:
+                # the server holding the pinned slot, if it can take the request
+                slot = id_slot % self._total_slots()
+                for e in self.endpoints:
+                    n = e.n_slots or 1
+                    if slot < n:
+                        if e in candidates and e.healthy:
+                            endpoint, local_slot = e, slot
+                        break
+                    slot -= n
+            if endpoint is None:
+                # servers that failed their last poll are a last resort
+                endpoint = min(candidates, key=lambda e: (not e.healthy, e.load()))
+            endpoint.inflight += 1
+            return endpoint, local_slot
+
+    def _release(self, endpoint: _Endpoint):
+        with self.lock:
+            endpoint.inflight -= 1
+
+    def _failed(self, endpoint: _Endpoint, error: requests.RequestException):
+        if (
+            isinstance(error, requests.HTTPError)
+            and error.response is not None
+            and error.response.status_code < 500
+        ):
+            raise error  # a bad request fails on every server
+        print(f"LLM server {endpoint.client.base_url} failed ({error}), trying another")
+        with self.lock:
+            endpoint.healthy = False
+
+    def post(self, endpoint: str, data: dict) -> dict:
+        data = dict(data)
+        id_slot = data.pop("id_slot", None)
+        tried = set()
+        last_error = None
+        while True:
+            server, local_slot = self._acquire(id_slot, tried)
+            if server is None:
+                raise last_error or requests.ConnectionError("No LLM server available")
+            request = data if local_slot is None else {**data, "id_slot": local_slot}
+            try:
+                return server.client.post(endpoint, request)
+            except requests.RequestException as e:
+                self._failed(server, e)
+                tried.add(id(server))
+                last_error = e
+            finally:
+                self._release(server)
+
+    def get(self, endpoint: str) -> dict:
+        return self._any_client().get(endpoint)
+
+    def _any_client(self) -> LLMClient:
+        with self.lock:
+            return min(self.endpoints, key=lambda e: (not e.healthy, e.load())).client
+
+    def props(self) -> dict:
+        return self._any_client().props()
+
+    def n_ctx(self) -> Optional[int]:
+        """The smallest slot context across servers, if reported."""
+        sizes = [e.client.n_ctx() for e in self.endpoints]
+        sizes = [n for n in sizes if n]
+        return min(sizes) if sizes else None
+
+    def _total_slots(self) -> int:
+        return sum(e.n_slots or 1 for e in self.endpoints)
+
+    def n_slots(self) -> Optional[int]:
+        """Number of slots across servers."""
+        with self.lock:
+            return self._total_slots()
+
+    def tokenize(self, text: str, with_pieces: bool = False) -> List:
+        """Token ids, or with_pieces, {"id", "piece"} dicts (the piece is a string, or bytes if not valid UTF-8)."""
+        return self.post("tokenize", {"content": text, "with_pieces": with_pieces})["tokens"]
+
+    def model_id(self) -> Optional[str]:
+        """Identity of the served model (all servers run the same one), from the first server reporting it."""
+        with self.lock:
+            endpoints = sorted(self.endpoints, key=lambda e: not e.healthy)
+        for endpoint in endpoints:
+            model = endpoint.client.model_id()
+            if model is not None:
+                return model
+        return None
+
+    def completion(self, data: dict) -> dict:
+        key = _cache_key(self, data)
+        if key is None:
+            return self.post("completion", data)
+
+        response = self.cache.get(key)
+        if response is not None:
+            return {**response, "cached": True}
+        response = self.post("completion", data)
+        self.cache.set(key, response)
+        return response
+
+    def stream_completion(self, data: dict, info: dict = None) -> Iterator[str]:
+        """See LLMClient.stream_completion, a server failing before the first chunk is replaced by another."""
+        if info is None:
+            info = {}
+        key = _cache_key(self, data)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                info.update(cached=True, timings=cached.get("timings"))
+                yield cached["content"]
+                return
+
+        data = dict(data)
+        id_slot = data.pop("id_slot", None)
+        tried = set()
+        last_error = None
+        while True:
+            server, local_slot = self._acquire(id_slot, tried)
+            if server is None:
+                raise last_error or requests.ConnectionError("No LLM server available")
+            request = data if local_slot is None else {**data, "id_slot": local_slot}
+            chunks = server.client.stream_completion(request, info=info)
+            content = []
+            try:
+                for chunk in chunks:
+                    content.append(chunk)
+                    yield chunk
+                if key is not None:
+                    self.cache.set(key, {"content": "".join(content), "timings": info.get("timings")})
+                return
+            except requests.RequestException as e:
+                if content:
+                    raise  # part of the output was already consumed
+                self._failed(server, e)
+                tried.add(id(server))
+                last_error = e
+            finally:
+                chunks.close()
+                self._release(server)
+
+    def close(self):
+        self._stop.set()
+        self._poll_session.close()
+        for endpoint in self.endpoints:
+            endpoint.client.close()
+
+
+def parse_endpoints(ip_address: str, port: int) -> List[Tuple[str, int]]:
+    """Servers from a comma-separated list of host or host:port entries, `port` by default."""
+    endpoints = []
+    for entry in ip_address.split(","):
+        entry = entry.strip()
+        entry = re.sub(r"^https?://", "", entry).rstrip("/")
+        if not entry:
+            continue
+        if ":" in entry:
+            host, entry_port = entry.rsplit(":", 1)
+            endpoints.append((host, int(entry_port)))
+        else:
+            endpoints.append((entry, int(port)))
+    return endpoints
+
+
+# one client (and thus one connection pool) per server, or one pool per list of servers
+_clients: Dict[Tuple, Union[LLMClient, EndpointPool]] = {}
+_clients_lock = threading.Lock()
+_cache: Optional[LLMCache] = None
+
+
+def get_llm_cache() -> Optional[LLMCache]:
+    """The response cache shared by all clients, None if disabled."""
+    global _cache
+    if _cache is None and LLM_CACHE_PATH:
+        _cache = LLMCache(LLM_CACHE_PATH, max_size_mb=LLM_CACHE_SIZE_MB)
+    return _cache
+
+
+def get_llm_client(ip_address: str, port: int, **kwargs) -> Union[LLMClient, EndpointPool]:
+    """
+    The shared client for a server, or an EndpointPool for several servers,
+    e.g., ip_address="krirag-api-1:8502,krirag-api-2:8502".
+    """
+    endpoints = parse_endpoints(ip_address, port)
+    key = tuple(endpoints)
+    with _clients_lock:
+        if key not in _clients:
+            kwargs.setdefault("cache", get_llm_cache())
+            if len(endpoints) == 1:
+                _clients[key] = LLMClient(*endpoints[0], **kwargs)
+            else:
+                _clients[key] = EndpointPool(endpoints, **kwargs)
+        return _clients[key]
+
+
 def pred(
     instruction,
     ip_address: str,
@@ -85,9 +571,15 @@ def pred(
     # max_p=0.9,  # maximum probability
     # top_p=0.9,  # nucleus sampling
     # top_k=40,  # consider top k tokens at each generation step
-    evaluate: bool = False,  # apply eval
+    evaluate: bool = False,  # parse the output as JSON
+    client: Union[LLMClient, EndpointPool] = None,  # defaults to the shared client for ip_address:port
+    cache_prompt: bool = True,  # reuse the KV cache of the longest common prompt prefix
+    id_slot: int = None,  # server slot to run on, e.g., the same slot for prompts sharing a prefix
+    stream: bool = False,  # stream the output, parsing fields as they complete
+    on_field: Callable[[str, Any], None] = None,  # stream: called with each completed top-level field
+    stop_when: Callable[[Dict[str, Any]], bool] = None,  # stream: stop generating once true for the fields so far
+    stage: str = None,  # metrics stage of the call, defaults to "llm:<schema>"
 ):
-    url = f"http://{ip_address}:{port}/completion"  # llama.cpp server
     if len(instruction) == 0:
         raise ValueError("Instruction cannot be empty")
 
@@ -96,35 +588,73 @@ def pred(
         "n_predict": max_tokens,
         "temperature": temp,
         "repeat_penalty": 1.2,  # 1.1 default,
+        "cache_prompt": cache_prompt,
     }
+    if id_slot is not None:
+        data["id_slot"] = id_slot
     if use_schema:
         data["json_schema"] = schemas[use_schema]
 
-    response = requests.post(url, headers=headers, data=json.dumps(data)).json()
-    response = response["content"]
+    if client is None:
+        client = get_llm_client(ip_address, port)
+    stage = stage or f"llm:{use_schema or 'text'}"
+    start = time.perf_counter()
+    if stream:
+        info = {}
+        try:
+            response, fields = _stream_fields(client, data, use_schema, on_field, stop_when, info)
+        finally:
+            get_metrics().record_llm(
+                stage, time.perf_counter() - start, info.get("timings"), cached=info.get("cached", False)
+            )
+        if evaluate and fields is not None:
+            return fields
+    else:
+        response = client.completion(data)
+        get_metrics().record_llm(
+            stage,
+            time.perf_counter() - start,
+            response.get("timings"),
+            cached=response.get("cached", False),
+        )
+        response = response["content"]
     if evaluate:
         return parse_llm_output(response)
     return response
 
 
+def _stream_fields(
+    client: LLMClient,
+    data: dict,
+    use_schema: str,
+    on_field: Callable[[str, Any], None],
+    stop_when: Callable[[Dict[str, Any]], bool],
+    info: dict = None,
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Streamed output and its fields: the fields generated before `stop_when` held,
+    the complete object if it matches the schema, or None otherwise.
+    """
+    parser = IncrementalJSONParser(schemas.get(use_schema), on_field=on_field)
+    chunks = client.stream_completion(data, info=info)
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            if stop_when is not None and stop_when(parser.fields):
+                return parser.text, dict(parser.fields)
+    finally:
+        chunks.close()
+    try:
+        return parser.text, parser.result()
+    except ValueError:
+        return parser.text, None
+
+
 def parse_llm_output(response: str):
+    """Parse an LLM output as JSON, raises ValueError if it is not."""
     if not response:
         return response
-    # spacing!
-    response = response.replace("\n", " ")
-    response = response.replace("\t", " ")
-    response = re.sub(r"\s+", " ", response)
-    response = response.strip()
-    # markdown ticks
-    response = response.replace("```python", "")
-    response = response.replace("```json", "")
-    response = response.replace("```", "")
-
-    response = response.replace("false", "False")
-    response = response.replace("true", "True")
-    response = response.replace("null", "None")
-
-    obj = eval(response)
+    obj = parse_json(response)
     if isinstance(obj, dict):
         # unify keys in case of capitalization.
         obj = {k.lower(): v for k, v in obj.items()}
@@ -143,6 +673,10 @@ def ask_llm(
     prompt_source: dict = None,  # see "question_and_reason_prompt" above.
     lang: str = "en",
     verbose: bool = False,
+    client: LLMClient = None,
+    on_field: Callable[[str, Any], None] = None,  # streams the output when given, see pred
+    stop_when: Callable[[Dict[str, Any]], bool] = None,  # streams the output when given, see pred
+    id_slot: int = None,  # see pred
 ) -> dict:
     text = re.sub(r"\.{3,}", "...", text)
 
@@ -158,20 +692,66 @@ def ask_llm(
     if verbose:
         print("Instruction", instruction)
 
-    output = pred(
-        instruction=instruction,
-        ip_address=ip_address,
-        port=port,
-        temp=temp,
-        max_tokens=tokens,
-        use_schema="default",
-    )
+    streaming = on_field is not None or stop_when is not None
+    try:
+        output = pred(
+            instruction=instruction,
+            ip_address=ip_address,
+            port=port,
+            temp=temp,
+            max_tokens=tokens,
+            use_schema="default",
+            client=client,
+            stage="llm:analysis",
+            id_slot=id_slot,
+            evaluate=streaming,
+            stream=streaming,
+            on_field=on_field,
+            stop_when=stop_when,
+        )
+    except ValueError as e:
+        print(f"{e}. Returning no output")
+        return None
+    if streaming:
+        return output  # parsed as it was generated
     if verbose:
         print("-*-" * 40)
         print(output)
         print("-*-" * 40)
     try:
         output = parse_llm_output(output)
-    except SyntaxError as e:
-        print("SyntaxError. Returning raw output")
+    except ValueError as e:
+        print(f"{e}. Returning raw output")
     return output
+
+
+def score_relevance(
+    query: str,
+    text: str,
+    ip_address: str,
+    port: int,
+    doc_id: str = "ID",
+    lang: str = "en",
+    client: LLMClient = None,
+    id_slot: int = None,
+) -> Optional[int]:
+    """Cheap relevance score (0-3) of a text for a query: a few generated tokens, score only."""
+    text = re.sub(r"\.{3,}", "...", text)
+    instruction = relevance_prompt[lang].format(query=query, text=text, doc_id=doc_id)
+    try:
+        output = pred(
+            instruction=instruction,
+            ip_address=ip_address,
+            port=port,
+            max_tokens=16,
+            use_schema="score",
+            stage="llm:prefilter",
+            evaluate=True,
+            client=client,
+            id_slot=id_slot,
+        )
+        return int(output["score"])
+    except (TypeError, KeyError, ValueError):
+        print("Error: no score from relevance pre-filter")
+        return None
+
@@ -9,175 +9,677 @@
 # - Tollef Jørgensen (Initial Development, 2024)
 # ------------------------------------------------------------------------------
 import os
+import queue
 import re
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
-from typing import List
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
 
 import jsonlines
-import streamlit as st
-from chromadb.types import Collection
 
 from llm import (
     ask_llm,
+    get_llm_cache,
+    get_llm_client,
     memory_prompt,
     parse_llm_output,
     pred,
-    question_and_reason_prompt,
+    question_and_reason_prompts,
+    score_relevance,
 )
-from utils.batch import get_sentence_batches
-from utils.chroma import get_matching_documents
+from utils.batch import (
+    TokenCounter,
+    chunk_items,
+    get_sentence_batches,
+    get_token_batches,
+    word_counts,
+)
+from utils.checkpoint import RunManifest
+from utils.metrics import get_metrics, set_metrics
+from utils.progress import ProgressCallback
+from utils.ranking import DOCUMENT_AGGREGATIONS
+from utils.rerank import rerank_score
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+# "rolling": each batch gets a summary of the memory so far, folded every `memory_every` batches
+# "reduce": batches are analyzed independently, and their summaries are folded afterwards, as many per call as fit
+MEMORY_STRATEGIES = ["rolling", "reduce"]
+# "query": the memory is carried across all documents of a query (documents are processed in order)
+# "document": the memory is restarted for each document, which makes documents independent
+MEMORY_SCOPES = ["query", "document"]
+# "words": approximate batches by whitespace-separated words
+# "tokens": exact batches with the server tokenizer, filling the context minus prompt, memory and new tokens
+BATCHING_MODES = ["words", "tokens"]
+# "dense": sentence embeddings only
+# "hybrid": dense and BM25 document rankings fused, for exact names, case numbers and law paragraphs
+RETRIEVAL_MODES = ["dense", "hybrid"]
+# "none": every batch gets the full analysis
+# "llm": a score-only LLM call (a few generated tokens) screens each batch first, scores 0-3
+# "reranker": a local cross-encoder screens each batch first, scores 0-1
+PREFILTER_MODES = ["none", "llm", "reranker"]
+PREFILTER_THRESHOLDS = {"llm": 1, "reranker": 0.1}  # default: batches scoring below are skipped
+# "default": the original analysis prompt
+# "prefix": static instructions first and the query, memory and document last, so the server reuses the prefix
+PROMPT_LAYOUTS = list(question_and_reason_prompts)
+
+# per-stage timings of the run, next to the checkpoint (not a .jsonl in the run folder, which are results)
+METRICS_FOLDER = "metrics"
+
+MEMORY_MAX_TOKENS: int = 1000  # max length of a memory summary
+MIN_BATCH_TOKENS: int = 256  # smallest useful token budget for the document text
+
+
+def summarize_memory(
+    memory: List[str],
+    query: str,
+    doc_id: str,
+    ip_address: str,
+    port: int,
+    id_slot: int = None,
+) -> str:
+    summary = pred(
+        instruction=memory_prompt.format(
+            previous_information=memory,
+            query=query,
+            DOC_ID=doc_id,
+        ),
+        ip_address=ip_address,
+        port=port,
+        max_tokens=MEMORY_MAX_TOKENS,
+        use_schema="summary",
+        stage="llm:memory",
+        id_slot=id_slot,
+    )
+    try:
+        summary = parse_llm_output(summary)
+    except ValueError:
+        pass  # keep the raw summary
+    if isinstance(summary, dict) and "summary" in summary:
+        summary = summary["summary"]
+    return summary
+
+
+def reduce_memory(
+    records: List[dict],
+    query: str,
+    ip_address: str,
+    port: int,
+    submit: Callable[..., Future],
+    budget: int,
+    count: Callable[[List[str]], List[int]] = word_counts,
+) -> str:
+    """
+    Fold the batch summaries of a query, as many per call as fit `budget` (measured by `count`, see chunk_items).
+    Each level is summarized concurrently, with `submit` (e.g., on the run's workers and their server slots),
+    so n summaries take about n/k calls for k summaries per call.
+    """
+    # (document references, summary)
+    level: List[Tuple[List[str], str]] = [
+        ([r["id"]], r["llm_output"]["summary"]) for r in records if r["llm_output"]["summary"]
+    ]
+    if len(level) == 0:
+        return ""
+
+    while len(level) > 1:
+        chunks = chunk_items([summary for _, summary in level], budget, count)
+        groups = []
+        start = 0
+        for chunk in chunks:
+            # chunks keep the order of the summaries
+            doc_ids = sorted({d for ids, _ in level[start : start + len(chunk)] for d in ids})
+            start += len(chunk)
+            if len(chunk) == 1:
+                groups.append((doc_ids, chunk[0], None))
+                continue
+            future = submit(
+                summarize_memory,
+                memory=chunk,
+                query=query,
+                doc_id=", ".join(doc_ids),
+                ip_address=ip_address,
+                port=port,
+            )
+            groups.append((doc_ids, None, future))
+        level = [
+            (doc_ids, summary if future is None else future.result())
+            for doc_ids, summary, future in groups
+        ]
+    return level[0][1]
+
+
+def _is_irrelevant(output) -> bool:
+    return isinstance(output, dict) and output.get("score") == 0
+
+
+def analyze_document(
+    query: str,
+    matched_doc: str,
+    texts: List[str],
+    ip_address: str,
+    port: int,
+    lang: str,
+    token_len: int,
+    new_tokens: int,
+    memory: List[str],
+    memory_strategy: str = "rolling",
+    memory_every: int = 1,
+    token_counter: TokenCounter = None,
+    checkpoint: RunManifest = None,
+    prefilter: str = "none",
+    prefilter_threshold: float = None,
+    early_stop: bool = False,
+    prompt_layout: str = "default",
+    id_slot: int = None,
+    on_batch: Callable[[dict], None] = None,
+    stop: threading.Event = None,
+) -> Tuple[List[dict], List[str]]:
+    """
+    Analyze all batches of a single document.
+    Returns the records to write for the document and the updated memory.
+    The memory holds the last summary, followed by the batch summaries added since.
+    With a token_counter, token_len is the token budget of the prompt without the prompt template.
+    With a checkpoint, completed batches are restored instead of recomputed, and new ones are recorded.
+    With a prefilter, batches scoring below prefilter_threshold are skipped (no record, memory unchanged).
+    With early_stop, the output is streamed and generation stops at a 0 score, the batch is then skipped the same way.
+    With id_slot, the analysis runs on that server slot, where the prompt prefix of previous batches is cached.
+    With on_batch, each new record is also passed to it as soon as its batch completes (from this thread).
+    With stop, no further batch is started once it is set (the run failed or was stopped), raises CancelledError.
+    """
+    prompt_source = question_and_reason_prompts[prompt_layout]
+    DOC_ID: str = matched_doc
+    print(f"Doc {DOC_ID} has {len(texts)} sentences")
+
+    QUERY_MEMORY: List[str] = memory
+    records: List[dict] = []
+
+    # - some documents are LONG, batch them into smaller chunks
+    if token_counter is not None:
+        # the prompt template for this query and document shares the budget
+        template = prompt_source[lang].format(
+            query=query, text="", extra="", doc_id=DOC_ID
+        )
+        budget = token_len - token_counter.count([template])[0]
+        if budget < MIN_BATCH_TOKENS:
+            raise ValueError(
+                f"Only {budget} tokens left for the text of {DOC_ID}, lower new_tokens or increase the context length"
+            )
+        batches = get_token_batches(texts, token_counter.count(texts), budget)
+    else:
+        batches = get_sentence_batches(texts, token_len)
+    sentence_batch_map = batches["map"]
+    batches = batches["batches"]
+
+    for batch, batch_texts in batches.items():
+        if stop is not None and stop.is_set():
+            raise CancelledError(f"Run stopped before {DOC_ID} batch {batch + 1}/{len(batches)}")
+        done = checkpoint.get_unit(query, DOC_ID, batch) if checkpoint else None
+        if done is not None:
+            print(f"[{DOC_ID}] Restored batch {batch + 1}/{len(batches)} from checkpoint")
+            QUERY_MEMORY = done["memory"]
+            if done["record"] is not None:
+                records.append(done["record"])
+            continue
+
+        full_text: str = " ".join(batch_texts)
+        if prefilter != "none":
+            if prefilter == "llm":
+                relevance = score_relevance(
+                    query,
+                    full_text,
+                    ip_address=ip_address,
+                    port=port,
+                    doc_id=DOC_ID,
+                    lang=lang,
+                    id_slot=id_slot,
+                )
+            else:
+                relevance = rerank_score(query, batch_texts)
+            # batches without a score are analyzed in full
+            if relevance is not None and relevance < prefilter_threshold:
+                print(f"[{DOC_ID}] Skipped batch {batch + 1}/{len(batches)} (pre-filter score {relevance})")
+                if checkpoint is not None:
+                    checkpoint.add_unit(query, DOC_ID, batch, None, QUERY_MEMORY)
+                continue
+
+        print(f"[{DOC_ID}] Working with batch {batch + 1}/{len(batches)}")
+        prev_info: str = ""
+        if memory_strategy == "rolling" and len(QUERY_MEMORY) > memory_every:
+            # fold the previous summary and the batch summaries added since
+            prev_info = summarize_memory(
+                QUERY_MEMORY,
+                query=query,
+                doc_id=DOC_ID,
+                ip_address=ip_address,
+                port=port,
+                id_slot=id_slot,
+            )
+            print(f"Identified previous information: {prev_info}")
+            QUERY_MEMORY = [prev_info]
+        elif memory_strategy == "rolling" and len(QUERY_MEMORY) > 0:
+            # reuse the last summary until enough new batches are seen
+            prev_info = QUERY_MEMORY[0]
+
+        print(f"Getting preds from LLM with previous info: {prev_info}")
+        stream_kwargs = {}
+        if early_stop:
+
+            def on_field(key: str, value):
+                if key == "score":
+                    print(f"[{DOC_ID}] Batch {batch + 1}/{len(batches)} scored {value}")
+
+            stream_kwargs = dict(on_field=on_field, stop_when=_is_irrelevant)
+
+        llm_output = ask_llm(
+            query=query,
+            text=full_text,
+            ip_address=ip_address,
+            port=port,
+            extra=prev_info,
+            doc_id=DOC_ID,
+            tokens=new_tokens,
+            prompt_source=prompt_source,
+            verbose=False,
+            lang=lang,
+            id_slot=id_slot,
+            **stream_kwargs,
+        )
+        if early_stop and _is_irrelevant(llm_output) and "summary" not in llm_output:
+            print(f"[{DOC_ID}] Stopped batch {batch + 1}/{len(batches)} early (score 0)")
+            if checkpoint is not None:
+                checkpoint.add_unit(query, DOC_ID, batch, None, QUERY_MEMORY)
+            continue
+
+        tmp_summary: str = ""
+        if isinstance(llm_output, dict) and "summary" in llm_output:
+            tmp_summary = llm_output["summary"]
+        if len(QUERY_MEMORY) == 0:
+            QUERY_MEMORY = [prev_info]
+        QUERY_MEMORY = QUERY_MEMORY + [tmp_summary]
+        print(f"Updated previous info:", QUERY_MEMORY)
+        json_record = {
+            "id": matched_doc,
+            "batch": batch,
+            "query": query,
+            "llm_output": llm_output,
+            "sentences_in_batch": sentence_batch_map[batch],
+            "text": full_text,
+            "memory": QUERY_MEMORY,
+        }
+
+        try:
+            keys = llm_output.keys()
+            assert "questions" in keys
+            assert "score" in keys
+            assert "summary" in keys
+        except (AssertionError, AttributeError):
+            print("Error: missing keys in llm_output")
+            print(llm_output)
+            print("___")
+            json_record = None
+
+        if checkpoint is not None:
+            checkpoint.add_unit(query, DOC_ID, batch, json_record, QUERY_MEMORY)
+        if json_record is not None:
+            records.append(json_record)
+            if on_batch is not None:
+                on_batch(json_record)
+
+    return records, QUERY_MEMORY
+
+
+def _analyze_chain(
+    query: str,
+    documents: List[str],
+    texts: Dict[str, List[str]],
+    futures: List[Future],
+    **kwargs,
+):
+    """Analyze the documents of a query in order, carrying the memory across documents."""
+    memory: List[str] = []
+    stop = kwargs.get("stop")
+    for i, matched_doc in enumerate(documents):
+        if stop is not None and stop.is_set():
+            for future in futures[i:]:
+                future.cancel()
+            return
+        try:
+            records, memory = analyze_document(
+                query=query,
+                matched_doc=matched_doc,
+                texts=texts[matched_doc],
+                memory=memory,
+                **kwargs,
+            )
+        except Exception as e:
+            # the remaining documents depend on this one's memory
+            for future in futures[i:]:
+                future.set_exception(e)
+            return
+        futures[i].set_result((records, memory))
 
 
 def run_rag(
     queries: List[str],
-    collection: Collection,
+    collection: "Collection",
     ip_address: str,
     port: int,
     lang: str = "en",
-    top_n: int = 10,
+    top_n: int = 10,  # sentences to match per query
+    top_k: int = None,  # documents to analyze per query, most relevant first (None: all matched)
+    aggregation: str = "max",  # see DOCUMENT_AGGREGATIONS
+    retrieval: str = "hybrid",  # see RETRIEVAL_MODES
+    prefilter: str = "none",  # see PREFILTER_MODES
+    prefilter_threshold: float = None,  # default: PREFILTER_THRESHOLDS
+    early_stop: bool = False,  # stream the analysis and stop at a 0 score, such batches get no record
+    prompt_layout: str = "default",  # see PROMPT_LAYOUTS
     llm_ctx_len: int = 8168,
     new_tokens: int = 2048,
+    n_parallel: int = 1,  # max in-flight LLM requests, match the server slots (llama.cpp -np)
+    memory_scope: str = "query",  # see MEMORY_SCOPES
+    memory_strategy: str = "rolling",  # see MEMORY_STRATEGIES
+    memory_every: int = 1,  # rolling: summarize the memory every n batches
+    batching: str = "words",  # see BATCHING_MODES
+    resume: str = None,  # output folder of an interrupted run to continue
+    callback: ProgressCallback = None,  # receives queries and records, in output order
 ) -> str:
+    # chromadb is slow to import, load it with the first run
+    from utils.bm25 import open_bm25_index
+    from utils.chroma import query_documents
+    from utils.store import DocumentStore
+
     # print all locals that rag is running with:
     print(locals())
+    if callback is None:
+        callback = ProgressCallback()
+    if memory_scope not in MEMORY_SCOPES:
+        raise ValueError(f"memory_scope must be one of {MEMORY_SCOPES}")
+    if memory_strategy not in MEMORY_STRATEGIES:
+        raise ValueError(f"memory_strategy must be one of {MEMORY_STRATEGIES}")
+    if memory_every < 1:
+        raise ValueError("memory_every must be at least 1")
+    if batching not in BATCHING_MODES:
+        raise ValueError(f"batching must be one of {BATCHING_MODES}")
+    if aggregation not in DOCUMENT_AGGREGATIONS:
+        raise ValueError(f"aggregation must be one of {DOCUMENT_AGGREGATIONS}")
+    if retrieval not in RETRIEVAL_MODES:
+        raise ValueError(f"retrieval must be one of {RETRIEVAL_MODES}")
+    if prefilter not in PREFILTER_MODES:
+        raise ValueError(f"prefilter must be one of {PREFILTER_MODES}")
+    if prefilter != "none" and prefilter_threshold is None:
+        prefilter_threshold = PREFILTER_THRESHOLDS[prefilter]
+    if prompt_layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"prompt_layout must be one of {PROMPT_LAYOUTS}")
 
     start_of_program: str = datetime.now().strftime("%Y%m%d-%H%M%S")
-    _metadata: List[dict] = collection.get()["metadatas"]
-    _documents: set = set([d["document"] for d in _metadata])
+    store = DocumentStore(collection)
     if top_n == -1:
-        top_n = len(_documents)
+        top_n = len(store.names())
 
-    case_folder = f"RAG_Top{top_n}_{start_of_program}"
-    rag_path = os.path.join("output", case_folder)
+    if resume:
+        if not os.path.isdir(resume):
+            raise ValueError(f"No run to resume at {resume}")
+        rag_path = resume
+    else:
+        # a new run never shares its folder (and checkpoint), e.g., with a run started in the same second
+        os.makedirs("output", exist_ok=True)
+        case_folder = f"RAG_Top{top_n}_{start_of_program}"
+        rag_path = os.path.join("output", case_folder)
+        suffix = 1
+        while True:
+            try:
+                os.makedirs(rag_path)
+                break
+            except FileExistsError:
+                suffix += 1
+                rag_path = os.path.join("output", f"{case_folder}-{suffix}")
+    os.makedirs(os.path.join(rag_path, METRICS_FOLDER), exist_ok=True)
+    get_metrics().attach(os.path.join(rag_path, METRICS_FOLDER, "metrics.jsonl"))
 
-    for query in queries:
-        st.write(f"Processing query: {query}")
-        print(f"Query: {query}")
-        documents = get_matching_documents(
-            collection=collection,
-            query=query,
-            n_results=top_n,
+    # everything that changes the (query, document, batch) units or their outputs
+    checkpoint = RunManifest(rag_path)
+    checkpoint.check_params(
+        dict(
+            collection=collection.name,
+            lang=lang,
+            top_n=top_n,
+            top_k=top_k,
+            aggregation=aggregation,
+            retrieval=retrieval,
+            prefilter=prefilter,
+            prefilter_threshold=prefilter_threshold,
+            early_stop=early_stop,
+            prompt_layout=prompt_layout,
+            llm_ctx_len=llm_ctx_len,
+            new_tokens=new_tokens,
+            memory_scope=memory_scope,
+            memory_strategy=memory_strategy,
+            memory_every=memory_every,
+            batching=batching,
         )
-        print(f"Reduced from {top_n} to {len(documents)} documents")
+    )
 
+    token_counter = None
+    if batching == "tokens":
+        client = get_llm_client(ip_address, port)
+        token_counter = TokenCounter(client.tokenize)
+        # never exceed the context of a server slot
+        server_ctx = client.n_ctx()
+        if server_ctx:
+            llm_ctx_len = min(llm_ctx_len, server_ctx)
+        # room for the generated output and, with a rolling memory, the memory summary
+        memory_tokens = MEMORY_MAX_TOKENS + 50 if memory_strategy == "rolling" else 0
+        TOKEN_LEN: int = llm_ctx_len - new_tokens - memory_tokens
+        if TOKEN_LEN < MIN_BATCH_TOKENS:
+            raise ValueError(
+                f"Context length {llm_ctx_len} leaves no room for text with new_tokens={new_tokens}"
+            )
+    else:
         # 1 word can easily span 3-4 tokens
         # thus, to match the context length: ctx_len//4
         TOKEN_LEN: int = llm_ctx_len // 4
 
-        timestamp: str = datetime.now().strftime("%Y%m%d-%H%M%S")
-        filename: str = re.sub(r"[^\w\s]", "", query)
-        filename = filename.replace(" ", "-")
+    llm_kwargs = dict(
+        ip_address=ip_address,
+        port=port,
+        lang=lang,
+        token_len=TOKEN_LEN,
+        new_tokens=new_tokens,
+        memory_strategy=memory_strategy,
+        memory_every=memory_every,
+        token_counter=token_counter,
+        checkpoint=checkpoint,
+        prefilter=prefilter,
+        prefilter_threshold=prefilter_threshold,
+        early_stop=early_stop,
+        prompt_layout=prompt_layout,
+    )
 
-        output_path = os.path.join(rag_path, f"{timestamp}_{filename}.jsonl")
-        os.makedirs(os.path.join("output", case_folder), exist_ok=True)
+    # records of completed batches, from the workers to this thread, where the callback is called
+    completed: "queue.Queue[dict]" = queue.Queue()
+    llm_kwargs["on_batch"] = completed.put
+    # set when the run ends, units still running in the workers then stop before their next LLM call
+    stop = threading.Event()
+    llm_kwargs["stop"] = stop
 
-        # hold the "summary" field across documents to feed to the LLM
-        QUERY_MEMORY: List[str] = []
+    def report_batches():
+        while True:
+            try:
+                record = completed.get_nowait()
+            except queue.Empty:
+                return
+            callback.on_batch(record)
 
-        with jsonlines.open(output_path, "w") as writer:
-            for i, matched_doc in enumerate(documents):
-                matching_full_docs = collection.get(
-                    where={"document": {"$in": [matched_doc]}},
+    def wait_for(future: Future):
+        # batches of all queries are reported as they complete, while waiting for this one
+        while True:
+            try:
+                result = future.result(timeout=0.25)
+            except FutureTimeoutError:
+                report_batches()
+                continue
+            report_batches()
+            return result
+
+    # each worker is pinned to a server slot of its own: the batches of a document (and, with a query-wide memory,
+    # the documents of a query) run on the slot of their worker, so each call reuses the cached prompt prefix
+    # of the last, and two running units never share a slot while others are idle.
+    # without a reported slot count, the server picks the slot
+    n_slots = get_llm_client(ip_address, port).n_slots()
+    if n_slots:
+        n_slots = min(n_slots, max(1, n_parallel))
+    worker = threading.local()
+    worker_lock = threading.Lock()
+    n_workers = 0
+    metrics = get_metrics()
+
+    def pin_worker():
+        nonlocal n_workers
+        set_metrics(metrics)  # the workers record into the metrics of this run
+        with worker_lock:
+            worker.id_slot = n_workers % n_slots if n_slots else None
+            n_workers += 1
+
+    def on_worker_slot(unit, **kwargs):
+        return unit(id_slot=getattr(worker, "id_slot", None), **kwargs)
+
+    def submit(unit, **kwargs) -> Future:
+        # every LLM call of a unit (pre-filter, memory, analysis) runs on the slot of its worker
+        return executor.submit(on_worker_slot, unit, **kwargs)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, n_parallel), initializer=pin_worker)
+    try:
+        # retrieval for all new queries in a single embedding call and chroma query
+        new_queries = [q for q in dict.fromkeys(queries) if checkpoint.get_query(q) is None]
+        lexical = None
+        if retrieval == "hybrid" and new_queries:
+            lexical = open_bm25_index(collection.name)
+            if lexical.count() == 0:
+                print("No lexical index for this collection (populate it again), using dense retrieval")
+                lexical.close()
+                lexical = None
+        try:
+            with get_metrics().stage("retrieval", items=len(new_queries)):
+                ranked = dict(
+                    zip(
+                        new_queries,
+                        query_documents(
+                            collection,
+                            new_queries,
+                            top_n,
+                            top_k=top_k,
+                            aggregation=aggregation,
+                            lexical=lexical,
+                        ),
+                    )
                 )
-                texts: List[str] = matching_full_docs["documents"]
-                print(f"Doc {matched_doc} has {len(texts)} sentences")
-
-                DOC_ID: str = matched_doc
-                print(f"Doc ID: {DOC_ID}")
-
-                # - some documents are LONG, batch them into smaller chunks
-                batches = get_sentence_batches(texts, TOKEN_LEN)
-                sentence_batch_map = batches["map"]
-                batches = batches["batches"]
-
-                for batch, batch_texts in batches.items():
-                    print(f"Working with batch {batch + 1}/{len(batches)}")
-                    full_text: str = " ".join(batch_texts)
-                    prev_info: str = ""
-                    # no memory for the first batch
-                    if len(QUERY_MEMORY) > 0:
-                        prev_info = pred(
-                            instruction=memory_prompt.format(
-                                previous_information=QUERY_MEMORY,
-                                query=query,
-                                DOC_ID=DOC_ID,
-                            ),
-                            ip_address=ip_address,
-                            port=port,
-                            max_tokens=1000,
-                            use_schema="summary",
-                        )
-                        prev_info = parse_llm_output(prev_info)
-                        print(f"Identified previous information: {prev_info}")
-                        if isinstance(prev_info, dict) and "summary" in prev_info:
-                            prev_info = prev_info["summary"]
+        finally:
+            if lexical is not None:
+                lexical.close()
 
-                    print(f"Getting preds from LLM with previous info: {prev_info}")
+        matches: List[Tuple[str, List[str]]] = []
+        for query in queries:
+            print(f"Query: {query}")
+            previous = checkpoint.get_query(query)
+            if previous is not None:
+                # keep the documents of the interrupted run
+                matches.append((query, previous["documents"]))
+                continue
+            for document, score in ranked[query]:
+                print(f"\t{document}: {score:.3f}")
+            # most relevant first, the LLM spends its calls on the best matches before the rest
+            documents = [d for d, _ in ranked[query]]
+            print(f"Ranked {len(documents)} documents ({retrieval}, {aggregation})")
+            matches.append((query, documents))
 
-                    llm_output = ask_llm(
+        # sentences of all matched documents, in a single round trip
+        with get_metrics().stage("sentences") as stage:
+            texts: Dict[str, List[str]] = store.get_sentences(
+                [d for _, documents in matches for d in documents]
+            )
+            stage["items"] = len(texts)
+
+        # dispatch all queries up front, the executor bounds the number of in-flight requests
+        jobs = []
+        for query, documents in matches:
+            previous = checkpoint.get_query(query)
+            if previous is not None:
+                output_file = previous["output"]
+            else:
+                timestamp: str = datetime.now().strftime("%Y%m%d-%H%M%S")
+                filename: str = re.sub(r"[^\w\s]", "", query)
+                filename = filename.replace(" ", "-")
+                output_file = f"{timestamp}_{filename}.jsonl"
+                checkpoint.add_query(query, output_file, documents)
+            # rewritten in full, restored units are written along with the new ones
+            output_path = os.path.join(rag_path, output_file)
+            callback.on_query(query)
+
+            # without a rolling memory, documents never depend on each other
+            if memory_scope == "document" or memory_strategy == "reduce":
+                futures = []
+                for matched_doc in documents:
+                    futures.append(
+                        submit(
+                            analyze_document,
+                            query=query,
+                            matched_doc=matched_doc,
+                            texts=texts[matched_doc],
+                            memory=[],
+                            **llm_kwargs,
+                        )
+                    )
+            else:
+                futures = [Future() for _ in documents]
+                submit(
+                    _analyze_chain,
+                    query=query,
+                    documents=documents,
+                    texts=texts,
+                    futures=futures,
+                    **llm_kwargs,
+                )
+            jobs.append((query, output_path, futures))
+
+        # collect results in query and document order, regardless of completion order.
+        # the callback is only called from this thread (streamlit cannot render from the workers):
+        # on_batch in completion order while waiting, on_record in query and document order
+        for query, output_path, futures in jobs:
+            with jsonlines.open(output_path, "w") as writer:
+                if memory_strategy == "reduce":
+                    records = [r for future in futures for r in wait_for(future)[0]]
+                    query_memory = reduce_memory(
+                        records,
                         query=query,
-                        text=full_text,
                         ip_address=ip_address,
                         port=port,
-                        extra=prev_info,
-                        doc_id=DOC_ID,
-                        tokens=new_tokens,
-                        prompt_source=question_and_reason_prompt,
-                        verbose=False,
-                        lang=lang,
+                        submit=submit,
+                        budget=TOKEN_LEN,
+                        count=token_counter.count if token_counter is not None else word_counts,
                     )
+                    print(f"Reduced memory for query: {query_memory}")
+                    for json_record in records:
+                        json_record["memory"] = [query_memory, json_record["llm_output"]["summary"]]
+                        callback.on_record(json_record)
+                        writer.write(json_record)
+                    continue
+
+                for future in futures:
+                    records, _ = wait_for(future)
+                    for json_record in records:
+                        callback.on_record(json_record)
+                        writer.write(json_record)
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        checkpoint.close()
+        if token_counter is not None:
+            token_counter.close()
 
-                    tmp_summary: str = ""
-                    if isinstance(llm_output, dict) and "summary" in llm_output:
-                        tmp_summary = llm_output["summary"]
-                    QUERY_MEMORY = [prev_info, tmp_summary]
-                    print(f"Updated previous info:", QUERY_MEMORY)
-                    json_record = {
-                        "id": matched_doc,
-                        "batch": batch,
-                        "query": query,
-                        "llm_output": llm_output,
-                        "sentences_in_batch": sentence_batch_map[batch],
-                        "text": full_text,
-                        "memory": QUERY_MEMORY,
-                    }
-
-                    try:
-                        keys = llm_output.keys()
-                        assert "questions" in keys
-                        assert "score" in keys
-                        assert "summary" in keys
-                    except AssertionError:
-                        print("Error: missing keys in llm_output")
-                        print(llm_output)
-                        print("___")
-                        llm_output = {
-                            "questions": ["Error generating questions..."],
-                            "score": -1,
-                            "summary": "",
-                        }
-                        continue
-
-                    with st.expander(
-                        f"Results for {matched_doc} (relevance score: {llm_output['score']}/3)"
-                    ):
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            st.markdown(f"#### Query\n{query}")
-                            st.markdown(f"#### Generated questions")
-                            for q in llm_output["questions"]:
-                                if "question" in q:
-                                    st.markdown(f"- {q['question']}")
-                            st.markdown(f"#### Summary\n{llm_output['summary']}")
-
-                            st.markdown(f"#### Memory")
-                            for _prev_info in QUERY_MEMORY:
-                                if len(_prev_info) > 3:
-                                    st.markdown(f"- {_prev_info}")
-
-                        with col2:
-                            st.markdown(f"#### Full text")
-                            st.write(full_text)
-                        st.divider()
-                    writer.write(json_record)
+    cache = get_llm_cache()
+    if cache is not None:
+        print(f"LLM cache: {cache.stats()}")
     return rag_path
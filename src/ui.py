@@ -17,15 +17,30 @@ st.set_page_config(page_title="KriRAG", layout="wide")
 dotenv.load_dotenv()
 
 # remaining imports...
-import json
 import os
+import threading
 from datetime import datetime
 
-import pandas as pd
-
-from combine import meta_summary
-from initialize import load_and_cache_documents, populate_collection
-from rag import run_rag
+from combine import collect_results, meta_summary
+from initialize import (
+    get_embedding_model,
+    iter_records,
+    list_documents,
+    populate_collection,
+)
+from rag import (
+    BATCHING_MODES,
+    DOCUMENT_AGGREGATIONS,
+    MEMORY_SCOPES,
+    MEMORY_STRATEGIES,
+    PREFILTER_MODES,
+    PREFILTER_THRESHOLDS,
+    PROMPT_LAYOUTS,
+    RETRIEVAL_MODES,
+    run_rag,
+)
+from utils.metrics import Metrics, get_metrics, set_metrics
+from utils.progress import StreamlitCallback
 
 default_queries = [
     "some investigative query that attempts to figure out specific details about the case",
@@ -66,6 +81,29 @@ supported_languagess = [
 ]
 default_lang = "english"
 
+
+@st.cache_data
+def load_and_cache_documents(uploaded_file):
+    # the listing only: documents are read and segmented once, when they are ingested,
+    # which reports their paragraphs and sentences
+    num_docs = len(list_documents(uploaded_file))
+    if num_docs == 0:
+        raise ValueError("No data found in the uploaded file.")
+    st.info(f"Found {num_docs} documents")
+    return {"num_docs": num_docs}
+
+
+@st.cache_resource
+def warm_up_embedding_model() -> threading.Thread:
+    # once per process: the model loads in the background while the page renders,
+    # and populate_collection waits for it if it is needed before it is ready
+    thread = threading.Thread(target=get_embedding_model, daemon=True)
+    thread.start()
+    return thread
+
+
+warm_up_embedding_model()
+
 # css hack to remove top header
 st.markdown(
     """
@@ -83,8 +121,63 @@ subtext = "query-based analysis for criminal investigations"
 st.sidebar.header("Server Configuration")
 default_ip = "krirag-api"  # for docker
 # default_ip = "localhost"  # for local setup
-ip_address = st.sidebar.text_input("LLM Docker Name or IP Address", value=default_ip)
+ip_address = st.sidebar.text_input(
+    "LLM Docker Name or IP Address",
+    value=default_ip,
+    help="Several servers as a comma-separated list, e.g., 'krirag-api-1:8502,krirag-api-2:8502'. "
+    "Requests go to the least-loaded healthy server.",
+)
 port = st.sidebar.number_input("API Port", value=8502, step=1)
+n_parallel = st.sidebar.number_input(
+    "Parallel requests (match the server slots, llama.cpp -np, summed over servers)", value=1, min_value=1, step=1
+)
+memory_scope = st.sidebar.selectbox(
+    "Memory scope",
+    MEMORY_SCOPES,
+    help="'query' carries the memory across all documents of a query (sequential). "
+    "'document' restarts it per document, so documents can be processed in parallel.",
+)
+memory_strategy = st.sidebar.selectbox(
+    "Memory strategy",
+    MEMORY_STRATEGIES,
+    help="'rolling' summarizes the memory before each batch. "
+    "'reduce' analyzes batches independently and folds their summaries afterwards (fewer LLM calls).",
+)
+memory_every = st.sidebar.number_input(
+    "Summarize memory every n batches (rolling)", value=1, min_value=1, step=1
+)
+batching = st.sidebar.selectbox(
+    "Batching",
+    BATCHING_MODES,
+    help="'words' approximates the batch size by words. "
+    "'tokens' uses the server tokenizer to fill the context exactly.",
+)
+prefilter = st.sidebar.selectbox(
+    "Relevance pre-filter",
+    PREFILTER_MODES,
+    help="Screen each batch cheaply before the full analysis, and skip those scoring below the threshold. "
+    "'llm' asks the server for a score only (0-3), 'reranker' uses a local cross-encoder (0-1).",
+)
+prefilter_threshold = None
+if prefilter != "none":
+    prefilter_threshold = st.sidebar.number_input(
+        "Pre-filter threshold",
+        value=float(PREFILTER_THRESHOLDS[prefilter]),
+        min_value=0.0,
+        step=1.0 if prefilter == "llm" else 0.05,
+    )
+early_stop = st.sidebar.checkbox(
+    "Stop at irrelevant batches",
+    value=False,
+    help="Stream the analysis and stop generating as soon as a batch scores 0 (such batches are not shown).",
+)
+prompt_layout = st.sidebar.selectbox(
+    "Prompt layout",
+    PROMPT_LAYOUTS,
+    index=PROMPT_LAYOUTS.index("default"),
+    help="'prefix' puts the instructions first and the query, memory and document last, "
+    "so the server reuses the cached prompt prefix between calls. 'default' is the original prompt.",
+)
 
 # Add listeners for changes
 if st.sidebar.button("Update Configuration"):
@@ -124,7 +217,7 @@ with col1:
     )
 
     if _uploaded:
-        initialization = load_and_cache_documents(_uploaded, lang=lang_selector)
+        initialization = load_and_cache_documents(_uploaded)
 
         with col2:
             st.markdown("### Queries:")
@@ -136,17 +229,16 @@ with col1:
             )
 
         print(initialization.keys())
-        print(
-            f"Initialization complete.\nData size: {initialization['num_pages']} pages, {initialization['num_sents']} sentences."
-        )
+        print(f"Initialization complete.\nData size: {initialization['num_docs']} documents.")
         st.session_state.is_initialized = True
 
 st.divider()
 
-if st.session_state.is_initialized and "data" in initialization:
+if st.session_state.is_initialized and initialization:
     to_delete = st.checkbox(
         "Delete previously computed data (local database)",
         value=False,
+        help="Not needed when files change: new and changed files are embedded, removed files are deleted.",
     )
     if st.session_state.to_delete != to_delete:
         st.session_state.to_delete = to_delete
@@ -163,7 +255,7 @@ if st.session_state.is_initialized and "data" in initialization:
     top_n = st.slider(
         "Depth of search per query (how many sentences to match against).",
         10,
-        min(max(initialization["num_pages"], 10), 100),
+        100,
         10,
     )
     if st.session_state.get("last_top_n") != top_n:
@@ -172,15 +264,41 @@ if st.session_state.is_initialized and "data" in initialization:
     st.write(
         "Note: a higher slider value will increase processing time, but will likely find more relevant documents."
     )
+    top_k = st.number_input(
+        "Documents to analyze per query, most relevant first (0: all matched documents).",
+        value=0,
+        min_value=0,
+        step=1,
+    )
+    aggregation = st.selectbox(
+        "Document ranking",
+        DOCUMENT_AGGREGATIONS,
+        help="'max' ranks documents by their most similar sentence, 'sum' by all their matching sentences, "
+        "'rrf' by reciprocal rank fusion of their sentence ranks.",
+    )
+    retrieval = st.selectbox(
+        "Retrieval",
+        RETRIEVAL_MODES,
+        index=RETRIEVAL_MODES.index("hybrid"),
+        help="'hybrid' adds keyword (BM25) matching to the embeddings, "
+        "for exact names, case numbers and law paragraphs.",
+    )
+    resume_path = st.text_input(
+        "Resume an interrupted run (output folder, e.g. output/RAG_Top10_20240101-120000), leave empty for a new run:",
+        value="",
+    ).strip()
 
     if st.button("Run KriRAG", disabled=st.session_state.rag_started):
         st.session_state.rag_started = True
         start_time = datetime.now()
+        set_metrics(Metrics())
         with st.spinner("Analyzing..."):
             _, collection = populate_collection(
-                initialization["data"],
+                iter_records(_uploaded, lang=lang_selector),
+                total_documents=initialization["num_docs"],
                 collection_name=collection_name,
                 delete=st.session_state.to_delete,
+                callback=StreamlitCallback(),
             )
             rag_path = run_rag(
                 queries=queries,
@@ -189,33 +307,46 @@ if st.session_state.is_initialized and "data" in initialization:
                 port=port,
                 lang="en",
                 top_n=top_n,
+                top_k=top_k or None,
+                aggregation=aggregation,
+                retrieval=retrieval,
+                prefilter=prefilter,
+                prefilter_threshold=prefilter_threshold,
+                early_stop=early_stop,
+                prompt_layout=prompt_layout,
                 llm_ctx_len=8168,
                 new_tokens=4096,
+                n_parallel=n_parallel,
+                memory_scope=memory_scope,
+                memory_strategy=memory_strategy,
+                memory_every=memory_every,
+                batching=batching,
+                resume=resume_path or None,
+                callback=StreamlitCallback(),
             )
         with st.spinner("Processing findings..."):
-            meta = meta_summary(rag_path, ip_address=ip_address, port=port)
+            meta = meta_summary(
+                rag_path, ip_address=ip_address, port=port, n_parallel=n_parallel
+            )
             st.write("### Meta-summary of queries:")
             for m_id, meta_dict in enumerate(meta):
                 st.write(f"Query: {meta_dict['query']}")
                 st.write(f"{meta_dict['summary']}")
+                if meta_dict["references"]:
+                    st.write(f"References: {', '.join(map(str, meta_dict['references']))}")
                 st.divider()
 
+        st.write("### Timing")
+        st.table(get_metrics().summary())
+        get_metrics().close()
+
         end_time = datetime.now()
         diff_time = end_time - start_time
         diff_sec = int(diff_time.total_seconds())
         st.info(f"Analysis Complete in {diff_sec} seconds! Download the CSV below.")
         st.session_state.rag_started = False
 
-        all_data = []
-        for file in sorted(os.listdir(rag_path)):
-            if file.endswith(".jsonl"):
-                file_path = os.path.join(rag_path, file)
-                with open(file_path, "r") as f:
-                    for line in f:
-                        data = json.loads(line)
-                        data["id"] = file
-                        all_data.append(data)
-        results_df = pd.DataFrame(all_data)
+        results_df = collect_results(rag_path)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         csv_path = os.path.join(rag_path, "combined_results.csv")
         results_df.to_csv(csv_path, index=False)
@@ -9,8 +9,13 @@
 # - Tollef Jørgensen (Initial Development, 2024)
 # ------------------------------------------------------------------------------
 
+import threading
 from collections import defaultdict
-from typing import Any, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+from typing import Any, Callable, Dict, List, Tuple
+
+MAX_TOKENIZE_CHARS = 100_000  # text per /tokenize request
 
 
 def get_sentence_batches(texts: List[str], TOKEN_LEN: int) -> Dict[str, Any]:
@@ -23,15 +28,149 @@ def get_sentence_batches(texts: List[str], TOKEN_LEN: int) -> Dict[str, Any]:
     sentence_batch_map = defaultdict(list)
 
     for s_id, sentence in enumerate(texts):
-        sentence_batch_map[current_batch].append(s_id)
         tokens_in_sent = len(sentence.split())
         current_token_count += tokens_in_sent
         if current_token_count > TOKEN_LEN:
             current_token_count = 0
             current_batch += 1
+        sentence_batch_map[current_batch].append(s_id)
+        token_batches[current_batch].append(sentence)
+
+    return {
+        "batches": token_batches,
+        "map": sentence_batch_map,
+    }
+
+
+class TokenCounter:
+    """
+    Token counts of sentences with the tokenizer of the served model (e.g., llama.cpp /tokenize).
+    Counts are cached. Unseen sentences are tokenized together, joined as in the prompt, in one request
+    per MAX_TOKENIZE_CHARS, and split back by the token pieces.
+    Servers that do not return pieces get one request per sentence, on a shared pool.
+    """
+
+    def __init__(self, tokenize: Callable[..., List], n_workers: int = 8):
+        self.tokenize = tokenize
+        self.n_workers = n_workers
+        self.cache: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self._executor: ThreadPoolExecutor = None
+
+    def count(self, texts: List[str]) -> List[int]:
+        with self.lock:
+            missing = [t for t in dict.fromkeys(texts) if t not in self.cache]
+        if missing:
+            counts = []
+            start = 0
+            while start < len(missing):
+                end = start + 1
+                size = len(missing[start])
+                while end < len(missing) and size + len(missing[end]) < MAX_TOKENIZE_CHARS:
+                    size += len(missing[end])
+                    end += 1
+                counts.extend(self._count_joined(missing[start:end]))
+                start = end
+            with self.lock:
+                self.cache.update(zip(missing, counts))
+        with self.lock:
+            return [self.cache[t] for t in texts]
+
+    def _count_joined(self, texts: List[str]) -> List[int]:
+        # sentences are joined by a space in the prompt, count them the same way:
+        # each token counts for the sentence its first byte falls in
+        segments = [(" " + t).encode("utf-8") for t in texts]
+        ends = list(accumulate(len(s) for s in segments))
+        tokens = self.tokenize(b"".join(segments).decode("utf-8"), with_pieces=True)
+        if tokens and not isinstance(tokens[0], dict):
+            return self._count_each(texts)
+
+        counts = [0] * len(texts)
+        offset = 0
+        i = 0
+        for token in tokens:
+            piece = token["piece"]
+            while i < len(ends) - 1 and offset >= ends[i]:
+                i += 1
+            counts[i] += 1
+            offset += len(piece.encode("utf-8")) if isinstance(piece, str) else len(piece)
+        if abs(offset - ends[-1]) > 1:
+            # pieces that do not add up to the text (e.g., a normalizing tokenizer), count exactly
+            return self._count_each(texts)
+        return counts
+
+    def _count_each(self, texts: List[str]) -> List[int]:
+        with self.lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        return list(self._executor.map(lambda t: len(self.tokenize(" " + t)), texts))
+
+    def close(self):
+        with self.lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+
+
+def get_token_batches(
+    texts: List[str], token_counts: List[int], TOKEN_BUDGET: int
+) -> Dict[str, Any]:
+    """
+    Pack consecutive sentences into batches of at most TOKEN_BUDGET tokens.
+    A sentence longer than the budget is kept whole in a batch of its own.
+    Same output format as get_sentence_batches.
+    """
+    token_batches = defaultdict(list)
+    sentence_batch_map = defaultdict(list)
+    current_token_count = 0
+    current_batch = 0
+
+    for s_id, (sentence, tokens_in_sent) in enumerate(zip(texts, token_counts)):
+        if current_token_count > 0 and current_token_count + tokens_in_sent > TOKEN_BUDGET:
+            current_token_count = 0
+            current_batch += 1
+        current_token_count += tokens_in_sent
+        sentence_batch_map[current_batch].append(s_id)
         token_batches[current_batch].append(sentence)
 
     return {
         "batches": token_batches,
         "map": sentence_batch_map,
     }
+
+
+def word_counts(texts: List[str]) -> List[int]:
+    return [len(t.split()) for t in texts]
+
+
+def truncate_item(item: str, size: int, limit: int, count: Callable[[List[str]], List[int]]) -> Tuple[str, int]:
+    """Cut an item at word boundaries until it is at most `limit` long (in the unit of `count`)."""
+    words = item.split()
+    while size > limit and len(words) > 1:
+        keep = min(len(words) - 1, max(1, len(words) * limit // size))
+        words = words[:keep]
+        item = " ".join(words)
+        size = count([item])[0]
+    return item, size
+
+
+def chunk_items(
+    items: List[str], budget: int, count: Callable[[List[str]], List[int]] = word_counts
+) -> List[List[str]]:
+    """
+    Greedily group items into chunks of at most `budget` (words, or tokens with a token `count`).
+    Items are truncated to half the budget, so any two fit a chunk: a reduction folding each chunk
+    into one item at least halves the number of items per level, and always terminates.
+    """
+    limit = (budget - 2) // 2  # two items and their newlines
+    chunks: List[List[str]] = []
+    size = 0
+    for item, item_size in zip(items, count(items)):
+        if item_size > limit:
+            item, item_size = truncate_item(item, item_size, limit, count)
+        item_size += 1  # the newline joining the items
+        if not chunks or size + item_size > budget:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(item)
+        size += item_size
+    return chunks
@@ -0,0 +1,168 @@
+# ------------------------------------------------------------------------------
+# File: bm25.py
+# Description: persistent BM25 sentence index for lexical retrieval in KriRAG
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Set, Tuple
+
+# lexical indexes live next to the chroma folder, one per collection
+BM25_PATH = os.getenv("BM25_PATH", "bm25")
+SQLITE_MAX_VARIABLES = 900
+# terms in a larger share of the sentences (e.g., "the", "in") are not scored, they barely rank and match most rows
+BM25_MAX_DF = float(os.getenv("BM25_MAX_DF", 0.1))
+
+# words, numbers and section signs, e.g., "straffeloven § 321" -> ["straffeloven", "§", "321"]
+TOKEN_PATTERN = re.compile(r"§|\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(unicodedata.normalize("NFC", text).lower())
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the sentences of a collection, stored as an inverted index in sqlite.
+    Exact names, case numbers and law paragraphs are matched lexically, complementing the dense embeddings.
+    Documents are added and deleted as a whole, so the index follows incremental ingestion.
+
+    Tables:
+        sentences: (document, sent_id) -> length in tokens
+        postings: (term, document, sent_id) -> term frequency
+    """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sentences (
+                document TEXT, sent_id INTEGER, length INTEGER,
+                PRIMARY KEY (document, sent_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT, document TEXT, sent_id INTEGER, tf INTEGER,
+                PRIMARY KEY (term, document, sent_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_document ON postings (document);
+            """
+        )
+        self.conn.commit()
+
+    def documents(self) -> Set[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT DISTINCT document FROM sentences").fetchall()
+        return {r[0] for r in rows}
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM sentences").fetchone()[0]
+
+    def add(self, records: Iterable[Dict[str, any]]):
+        """Index id/sent_id/text records (see iter_records)."""
+        sentences = []
+        postings = []
+        for row in records:
+            terms = Counter(tokenize(row["text"]))
+            sentences.append((row["id"], row["sent_id"], sum(terms.values())))
+            postings.extend((t, row["id"], row["sent_id"], tf) for t, tf in terms.items())
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO sentences VALUES (?, ?, ?)", sentences)
+            self.conn.executemany("INSERT OR REPLACE INTO postings VALUES (?, ?, ?, ?)", postings)
+            self.conn.commit()
+
+    def delete(self, documents: List[str]):
+        with self.lock:
+            for i in range(0, len(documents), SQLITE_MAX_VARIABLES):
+                chunk = documents[i : i + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(chunk))
+                self.conn.execute(f"DELETE FROM sentences WHERE document IN ({placeholders})", chunk)
+                self.conn.execute(f"DELETE FROM postings WHERE document IN ({placeholders})", chunk)
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM sentences")
+            self.conn.execute("DELETE FROM postings")
+            self.conn.commit()
+
+    def query(self, query: str, n_results: int) -> List[Tuple[str, float]]:
+        """
+        The `n_results` best matching sentences, as (document, score) pairs, best first.
+        Sentences are scored and ranked in sqlite, only the best ones are returned.
+        Terms in more than BM25_MAX_DF of the sentences are skipped, unless the query has no other terms.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))[: SQLITE_MAX_VARIABLES // 2]
+        if not terms:
+            return []
+        placeholders = ",".join("?" * len(terms))
+        with self.lock:
+            n_sentences, avg_length = self.conn.execute(
+                "SELECT COUNT(*), AVG(length) FROM sentences"
+            ).fetchone()
+            if not n_sentences:
+                return []
+            df = dict(
+                self.conn.execute(
+                    f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term",
+                    terms,
+                ).fetchall()
+            )
+            if not df:
+                return []
+            selective = {t: n for t, n in df.items() if n <= BM25_MAX_DF * n_sentences}
+            if not selective:
+                # only common terms, the rarest one still ranks
+                rarest = min(df, key=df.get)
+                selective = {rarest: df[rarest]}
+            idf = [
+                (t, math.log((n_sentences - n + 0.5) / (n + 0.5) + 1.0)) for t, n in selective.items()
+            ]
+            values = ",".join(f"(:t{i}, :idf{i})" for i in range(len(idf)))
+            rows = self.conn.execute(
+                f"""
+                WITH q(term, idf) AS (VALUES {values})
+                SELECT p.document, SUM(
+                    q.idf * p.tf * (:k1 + 1.0)
+                    / (p.tf + :k1 * (1.0 - :b + :b * s.length / :avg_length))
+                ) AS score
+                FROM q
+                JOIN postings p ON p.term = q.term
+                JOIN sentences s ON s.document = p.document AND s.sent_id = p.sent_id
+                GROUP BY p.document, p.sent_id
+                ORDER BY score DESC, p.document, p.sent_id
+                LIMIT :n_results
+                """,
+                {
+                    **{f"t{i}": t for i, (t, _) in enumerate(idf)},
+                    **{f"idf{i}": w for i, (_, w) in enumerate(idf)},
+                    "k1": self.k1,
+                    "b": self.b,
+                    "avg_length": max(avg_length, 1e-9),
+                    "n_results": n_results,
+                },
+            ).fetchall()
+        return [(document, score) for document, score in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_bm25_index(collection_name: str) -> BM25Index:
+    return BM25Index(os.path.join(BM25_PATH, f"{collection_name}.sqlite"))
@@ -0,0 +1,113 @@
+# ------------------------------------------------------------------------------
+# File: cache.py
+# Description: persistent cache of llm responses for KriRAG (sqlite)
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+# request fields that only affect how the server computes a response, not the response
+NON_OUTPUT_FIELDS = {"cache_prompt", "id_slot", "stream"}
+
+
+class LLMCache:
+    """
+    On-disk cache of llama.cpp responses.
+    Keys combine the model identity with the full request (prompt, schema and sampling params).
+    The least recently used responses are evicted once the cache exceeds `max_size_mb`.
+    """
+
+    def __init__(self, path: str, max_size_mb: float = 512):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, size INTEGER, accessed REAL)"
+        )
+        self.conn.commit()
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, data: dict) -> str:
+        # fields that do not change the generated output
+        data = {k: v for k, v in data.items() if k not in NON_OUTPUT_FIELDS}
+        payload = json.dumps({"model": model, "request": data}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, response: dict):
+        value = json.dumps(response)
+        size = len(value.encode("utf-8"))
+        with self.lock:
+            previous = self.conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self.size += size - (previous[0] if previous else 0)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # drop the least recently used entries down to 90% of the limit
+        if self.size <= self.max_size:
+            return
+        target = int(self.max_size * 0.9)
+        rows = self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed ASC"
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size_mb": self.size / (1024 * 1024),
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
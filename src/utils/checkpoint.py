@@ -0,0 +1,108 @@
+# ------------------------------------------------------------------------------
+# File: checkpoint.py
+# Description: run manifest for resumable RAG runs in KriRAG
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+CHECKPOINT_FOLDER = "checkpoint"
+
+
+class RunManifest:
+    """
+    Records the completed (query, document, batch) units of a run in its output folder.
+    Each unit stores its output record and the memory after it, so a run can resume
+    from the last completed unit of every query.
+
+    Layout (under <rag_path>/checkpoint):
+        run.json: run parameters, and per query its output file and matched documents
+        units.jsonl: one line per completed unit, appended as units complete
+    """
+
+    def __init__(self, rag_path: str):
+        self.dir = os.path.join(rag_path, CHECKPOINT_FOLDER)
+        os.makedirs(self.dir, exist_ok=True)
+        self.run_path = os.path.join(self.dir, "run.json")
+        self.units_path = os.path.join(self.dir, "units.jsonl")
+        self.lock = threading.Lock()
+
+        self.run: Dict[str, Any] = {"params": {}, "queries": {}}
+        if os.path.exists(self.run_path):
+            with open(self.run_path, "r", encoding="utf-8") as f:
+                self.run = json.load(f)
+
+        self.units: Dict[Tuple[str, str, int], dict] = {}
+        if os.path.exists(self.units_path):
+            with open(self.units_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        unit = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a partially written line from an interrupted run
+                        continue
+                    key = (unit["query"], unit["document"], unit["batch"])
+                    self.units[key] = unit
+        self._units_file = open(self.units_path, "a", encoding="utf-8")
+
+    def check_params(self, params: Dict[str, Any]):
+        """Store the run parameters, or make sure they match those of the run being resumed."""
+        previous = self.run["params"]
+        if previous:
+            changed = [k for k, v in params.items() if k in previous and previous[k] != v]
+            if changed:
+                raise ValueError(f"Cannot resume run with changed parameters: {changed}")
+        self.run["params"] = {**previous, **params}
+        self._save_run()
+
+    def get_query(self, query: str) -> Optional[dict]:
+        return self.run["queries"].get(query)
+
+    def add_query(self, query: str, output_file: str, documents: List[str]):
+        self.run["queries"][query] = {"output": output_file, "documents": documents}
+        self._save_run()
+
+    def get_unit(self, query: str, document: str, batch: int) -> Optional[dict]:
+        return self.units.get((query, document, batch))
+
+    def add_unit(
+        self,
+        query: str,
+        document: str,
+        batch: int,
+        record: Optional[dict],
+        memory: List[str],
+    ):
+        # record is None for batches without a valid llm output
+        unit = {
+            "query": query,
+            "document": document,
+            "batch": batch,
+            "record": record,
+            "memory": memory,
+        }
+        with self.lock:
+            if self._units_file.closed:
+                return  # units still finishing after the run was stopped
+            self.units[(query, document, batch)] = unit
+            self._units_file.write(json.dumps(unit, ensure_ascii=False) + "\n")
+            self._units_file.flush()
+
+    def _save_run(self):
+        with self.lock:
+            tmp_path = self.run_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.run, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.run_path)
+
+    def close(self):
+        with self.lock:
+            self._units_file.close()
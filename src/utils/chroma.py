@@ -9,28 +9,83 @@
 # - Tollef Jørgensen (Initial Development, 2024)
 # ------------------------------------------------------------------------------
 
+import json
 import logging
 import os
-from typing import List, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 import chromadb
+import numpy as np
 from chromadb import Client, Collection, Documents, EmbeddingFunction, Embeddings
 from chromadb.config import Settings
 from chromadb.utils.batch_utils import create_batches
-from pandas import DataFrame
-from sentence_transformers import SentenceTransformer
+
+from utils.bm25 import BM25Index
+from utils.embeddings import EmbeddingCache
+from utils.ranking import RANKING_OVERSAMPLE, fuse_rankings, rank_documents
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+    from sentence_transformers import SentenceTransformer
 
 
 class CustomEmbedder(EmbeddingFunction):
-    def __init__(self, model, batch_size=32):
+    def __init__(self, model, batch_size=32, cache: EmbeddingCache = None):
         self.model = model
         self.batch_size = batch_size
+        self.cache = cache
 
-    def __call__(self, input: Documents) -> Embeddings:
-        embeddings = self.model.encode(
+    def encode(self, input: List[str]):
+        return self.model.encode(
             input, convert_to_numpy=True, batch_size=self.batch_size
         )
-        return [e.tolist() for e in embeddings]
+
+    def __call__(self, input: Documents) -> Embeddings:
+        if self.cache is not None:
+            embeddings = self.cache.encode(input, self.encode)
+        else:
+            embeddings = self.encode(input)
+        # rows of the float32 matrix, no conversion to python floats
+        return list(embeddings)
+
+
+# collection-level metadata key holding the document index:
+# {document: {"sentences": count, "pages": [[page_id, first sent_id], ...]}}
+DOCUMENT_INDEX_KEY = "documents"
+
+
+def build_document_index(
+    data: List[Dict[str, any]], index: Dict[str, dict] = None
+) -> Dict[str, dict]:
+    """
+    Per-document sentence counts and page offsets, from id/page_id/sent_id records.
+    Pass `index` to extend it in place, e.g., with the next chunk of a stream.
+    """
+    if index is None:
+        index = {}
+    for row in data:
+        entry = index.setdefault(row["id"], {"sentences": 0, "pages": []})
+        entry["sentences"] = max(entry["sentences"], row["sent_id"] + 1)
+        pages = entry["pages"]
+        if not pages or pages[-1][0] != row["page_id"]:
+            pages.append([row["page_id"], row["sent_id"]])
+    return index
+
+
+def read_document_index(collection: Collection) -> Optional[Dict[str, dict]]:
+    metadata = collection.metadata or {}
+    if DOCUMENT_INDEX_KEY not in metadata:
+        return None
+    return json.loads(metadata[DOCUMENT_INDEX_KEY])
+
+
+def write_document_index(collection: Collection, index: Dict[str, dict]):
+    # the distance function cannot be modified after creation, leave it out
+    metadata = {
+        k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")
+    }
+    metadata[DOCUMENT_INDEX_KEY] = json.dumps(index, ensure_ascii=False)
+    collection.modify(metadata=metadata)
 
 
 def get_collection(collection_name: str = "rag"):
@@ -44,8 +99,9 @@ def get_collection(collection_name: str = "rag"):
 def get_client(
     persist: bool = True,
     delete: bool = False,
-    embedding_model: SentenceTransformer = None,
+    embedding_model: "SentenceTransformer" = None,
     collection_name: str = "rag",
+    embedding_cache: EmbeddingCache = None,
 ) -> Tuple[chromadb.Client, chromadb.Collection]:
     _settings = Settings(anonymized_telemetry=False)
     if persist:
@@ -61,7 +117,7 @@ def get_client(
             logging.error(e)
             logging.info("Proceeding as normal.")
 
-    embedding_function = CustomEmbedder(embedding_model)
+    embedding_function = CustomEmbedder(embedding_model, cache=embedding_cache)
     collection = chroma_client.create_collection(
         name=collection_name, embedding_function=embedding_function, get_or_create=True
     )
@@ -69,6 +125,25 @@ def get_client(
     return chroma_client, collection
 
 
+def add_in_batches(
+    client: Client,
+    collection: Collection,
+    ids: List[str],
+    embeddings: np.ndarray,
+    metadatas: List[dict],
+    documents: List[str],
+):
+    """Add rows in slices of the client's max batch size, keeping embeddings as a numpy matrix."""
+    batch_size = client.get_max_batch_size()
+    for i in range(0, len(ids), batch_size):
+        collection.add(
+            ids=ids[i : i + batch_size],
+            embeddings=embeddings[i : i + batch_size],
+            metadatas=metadatas[i : i + batch_size],
+            documents=documents[i : i + batch_size],
+        )
+
+
 def peek(collection: chromadb.Collection, count: int):
     sample = collection.peek(limit=count)
     for key, val in sample.items():
@@ -84,8 +159,8 @@ def peek(collection: chromadb.Collection, count: int):
 
 def update_collection(
     client: Client,
-    model: SentenceTransformer,
-    df: DataFrame,
+    model: "SentenceTransformer",
+    df: "DataFrame",
     collection: Collection,
     DOCUMENTS_TEXT_COLUMN,
     DOCUMENTS_ID_COLUMN,
@@ -123,14 +198,58 @@ def update_collection(
             )
 
 
+def query_documents(
+    collection: Collection,
+    queries: List[str],
+    n_results: int,
+    top_k: int = None,
+    aggregation: str = "max",
+    lexical: BM25Index = None,
+) -> List[List[Tuple[str, float]]]:
+    """
+    Documents matching each query, as (document, score) pairs ranked by `rank_documents`.
+    All queries are embedded in a single call and searched in a single `query`.
+    With `top_k`, at least RANKING_OVERSAMPLE sentences are fetched per requested document.
+    Sentence scores are 1 / (1 + distance), higher is more similar.
+    With a `lexical` index, the dense and BM25 document rankings are fused (scores are then RRF scores).
+    Without `top_k`, the fused ranking keeps as many documents as the dense one, so hybrid retrieval
+    reorders the documents to analyze rather than adding to them.
+    """
+    if not queries:
+        return []
+    if top_k:
+        n_results = max(n_results, top_k * RANKING_OVERSAMPLE)
+    n_results = max(1, min(n_results, collection.count()))
+    query_result = collection.query(
+        query_texts=list(queries), n_results=n_results, include=["metadatas", "distances"]
+    )
+    ranked = []
+    for metadatas, distances in zip(query_result["metadatas"], query_result["distances"]):
+        hits = [
+            (meta["document"], 1.0 / (1.0 + distance))
+            for meta, distance in zip(metadatas, distances)
+        ]
+        ranked.append(rank_documents(hits, aggregation=aggregation, top_k=top_k))
+
+    if lexical is not None:
+        for i, query in enumerate(queries):
+            lexical_ranked = rank_documents(
+                lexical.query(query, n_results), aggregation=aggregation, top_k=top_k
+            )
+            limit = top_k or len(ranked[i])
+            ranked[i] = fuse_rankings([ranked[i], lexical_ranked])[:limit]
+    return ranked
+
+
 def get_matching_documents(
-    collection: Collection, query: str, n_results: int
-) -> List[str]:
-    query_result = collection.query(query_texts=query, n_results=n_results)
-    query_result = {
-        k: v[0] for k, v in query_result.items() if isinstance(v, list) and len(v) > 0
-    }
-    metadata = query_result["metadatas"]
-    documents = [d["document"] for d in metadata]
-    documents = sorted(list(set(documents)))
-    return documents
+    collection: Collection,
+    query: str,
+    n_results: int,
+    top_k: int = None,
+    aggregation: str = "max",
+    lexical: BM25Index = None,
+) -> List[Tuple[str, float]]:
+    """Documents matching a single query, as (document, score) pairs, most relevant first (see query_documents)."""
+    return query_documents(
+        collection, [query], n_results, top_k=top_k, aggregation=aggregation, lexical=lexical
+    )[0]
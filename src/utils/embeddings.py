@@ -0,0 +1,200 @@
+# ------------------------------------------------------------------------------
+# File: embeddings.py
+# Description: persistent sentence embedding cache for KriRAG, shared across collections
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+from typing import Callable, Dict, List
+
+import numpy as np
+
+SQLITE_MAX_VARIABLES = 900
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def encode_bucketed(
+    texts: List[str],
+    encode: Callable[[List[str]], np.ndarray],
+    bucket_size: int = 1024,
+    callback: Callable[[int, int], None] = None,
+) -> np.ndarray:
+    """
+    Encode texts sorted by length, `bucket_size` texts per `encode` call, and return them in input order.
+    Batches then hold sentences of similar length (little padding), and progress is reported per bucket.
+    """
+    n = len(texts)
+    # longest first: the largest (slowest) batches come first, and memory peaks early
+    order = np.argsort([-len(t) for t in texts], kind="stable")
+    embeddings = None
+    for start in range(0, n, bucket_size):
+        idx = order[start : start + bucket_size]
+        bucket = np.asarray(encode([texts[i] for i in idx]), dtype=np.float32)
+        if embeddings is None:
+            embeddings = np.empty((n, bucket.shape[1]), dtype=np.float32)
+        embeddings[idx] = bucket
+        if callback is not None:
+            callback(min(start + bucket_size, n), n)
+    if embeddings is None:
+        return np.empty((0, 0), dtype=np.float32)
+    return embeddings
+
+
+def model_identity(model_path: str, dim: int) -> str:
+    """Identity of a local sentence-transformers model: its path, config and dimension."""
+    config_hash = "unknown"
+    config_path = os.path.join(model_path, "config.json")
+    if os.path.exists(config_path):
+        with open(config_path, "rb") as f:
+            config_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+    return f"{os.path.basename(os.path.normpath(model_path))}-{config_hash}-{dim}"
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of sentence embeddings for a single model.
+    Vectors are appended to a memory-mapped float32 matrix, and an sqlite index maps
+    the hash of each normalized sentence to its row. Identical sentences, within and across
+    collections, are embedded once.
+    Rows are allocated in an sqlite write transaction, so processes sharing the cache
+    (e.g., the cli and the ui) never write to the same rows.
+
+    Layout (under <path>/<model_id>):
+        vectors.f32: float32 matrix of shape (capacity, dim)
+        index.sqlite: sentence hash -> row
+    """
+
+    def __init__(self, path: str, model_id: str, dim: int, grow_rows: int = 65536):
+        self.dir = os.path.join(path, model_id)
+        os.makedirs(self.dir, exist_ok=True)
+        self.dim = dim
+        self.grow_rows = grow_rows
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(
+            os.path.join(self.dir, "index.sqlite"),
+            check_same_thread=False,
+            timeout=60,  # waits for writes of other processes
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS rows (hash TEXT PRIMARY KEY, row INTEGER)"
+        )
+        self.conn.commit()
+        self.size = self._next_row()
+
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        if not os.path.exists(self.vectors_path):
+            open(self.vectors_path, "wb").close()
+        self.capacity = os.path.getsize(self.vectors_path) // (dim * 4)
+        self.vectors = None
+        self._ensure_capacity(max(self.size, 1))
+
+    def _next_row(self) -> int:
+        # rows past the index (from an interrupted write) are simply overwritten
+        return self.conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM rows").fetchone()[0]
+
+    def _ensure_capacity(self, n_rows: int):
+        if self.vectors is not None and n_rows <= self.capacity:
+            return
+        # another process may have grown the file, it is only grown within a write transaction
+        capacity = max(self.capacity, os.path.getsize(self.vectors_path) // (self.dim * 4))
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        if n_rows > capacity:
+            capacity = max(n_rows, capacity * 2, self.grow_rows)
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(capacity * self.dim * 4)
+        self.capacity = capacity
+        self.vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim)
+        )
+
+    def _lookup(self, hashes: List[str]) -> Dict[str, int]:
+        rows = {}
+        for i in range(0, len(hashes), SQLITE_MAX_VARIABLES):
+            chunk = hashes[i : i + SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(chunk))
+            rows.update(
+                self.conn.execute(
+                    f"SELECT hash, row FROM rows WHERE hash IN ({placeholders})", chunk
+                ).fetchall()
+            )
+        return rows
+
+    def encode(
+        self, texts: List[str], encode: Callable[[List[str]], np.ndarray]
+    ) -> np.ndarray:
+        """Embeddings of `texts`, calling `encode` only for sentences not seen before."""
+        hashes = [text_hash(t) for t in texts]
+        with self.lock:
+            rows = self._lookup(list(set(hashes)))
+            # one text per unseen hash
+            missing: Dict[str, str] = {}
+            for h, t in zip(hashes, texts):
+                if h not in rows and h not in missing:
+                    missing[h] = t
+            self.hits += len(texts) - sum(1 for h in hashes if h in missing)
+            self.misses += sum(1 for h in hashes if h in missing)
+
+        if missing:
+            embeddings = np.asarray(encode(list(missing.values())), dtype=np.float32)
+
+        with self.lock:
+            if missing:
+                # the write transaction locks the index for other processes: rows are allocated
+                # past the last indexed row, and their vectors are written before the rows are committed
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # another thread or process may have added some of them meanwhile
+                    rows.update(self._lookup(list(missing.keys())))
+                    new = [(h, e) for h, e in zip(missing.keys(), embeddings) if h not in rows]
+                    if new:
+                        start = self._next_row()
+                        self._ensure_capacity(start + len(new))
+                        self.vectors[start : start + len(new)] = np.stack([e for _, e in new])
+                        self.vectors.flush()
+                        new_rows = [(h, start + i) for i, (h, _) in enumerate(new)]
+                        self.conn.executemany("INSERT INTO rows VALUES (?, ?)", new_rows)
+                        self.size = start + len(new)
+                        rows.update(new_rows)
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+            # rows added by other processes may lie past the mapped capacity
+            self._ensure_capacity(max(rows.values(), default=0) + 1)
+            return np.array(self.vectors[[rows[h] for h in hashes]])
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": self.size,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+            self.conn.close()
@@ -0,0 +1,193 @@
+# ------------------------------------------------------------------------------
+# File: jsonstream.py
+# Description: JSON parsing of (streamed) LLM outputs for KriRAG
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import ast
+import json
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+_FENCE = re.compile(r"```(?:json|python)?")
+
+
+def parse_json(text: str) -> Any:
+    """
+    Parse an LLM output as JSON, after removing markdown fences.
+    Control characters (e.g., raw newlines) are accepted in strings, LLMs often generate them.
+    Python-style literals (single quotes, True/None) are accepted as a fallback, without evaluating code.
+    Raises ValueError if the text is neither.
+    """
+    text = _FENCE.sub("", text).strip()
+    try:
+        return json.loads(text, strict=False)
+    except json.JSONDecodeError as e:
+        try:
+            return ast.literal_eval(text)
+        except (SyntaxError, ValueError, TypeError, MemoryError, RecursionError):
+            raise ValueError(f"Invalid JSON output: {e}") from None
+
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+
+def validate(value: Any, schema: dict, path: str = "$") -> List[str]:
+    """Errors of `value` against the subset of JSON schema used for generation (type, enum, properties, items)."""
+    errors: List[str] = []
+    expected = schema.get("type")
+    if expected in _TYPES:
+        ok = isinstance(value, _TYPES[expected])
+        if expected in ("integer", "number") and isinstance(value, bool):
+            ok = False
+        if not ok:
+            return [f"{path}: expected {expected}, got {type(value).__name__}"]
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: {value!r} not in {schema['enum']}")
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}: missing {key}")
+        for key, sub in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(validate(value[key], sub, f"{path}.{key}"))
+    if isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path}: fewer than {schema['minItems']} items")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            errors.append(f"{path}: more than {schema['maxItems']} items")
+        if "items" in schema:
+            for i, item in enumerate(value):
+                errors.extend(validate(item, schema["items"], f"{path}[{i}]"))
+    return errors
+
+
+class IncrementalJSONParser:
+    """
+    Parses a JSON object as it is generated, chunk by chunk.
+    Each top-level field is parsed (and validated against its schema) as soon as its value is complete,
+    so callers can act on e.g. a score before the rest of the object is generated.
+    """
+
+    def __init__(
+        self,
+        schema: dict = None,
+        on_field: Callable[[str, Any], None] = None,
+    ):
+        self.schema = schema or {}
+        self.on_field = on_field
+        self.text = ""
+        self.fields: Dict[str, Any] = {}
+        self.errors: List[str] = []
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expect = "object"  # object, key, colon, value, delimiter
+        self._token_start: Optional[int] = None
+        self._key: Optional[str] = None
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        """Add generated text, returns the fields completed by it."""
+        self.text += chunk
+        completed: Dict[str, Any] = {}
+        while self._pos < len(self.text) and not self.done:
+            i = self._pos
+            c = self.text[i]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._expect == "key":
+                        self._key = json.loads(self.text[self._token_start : i + 1], strict=False)
+                        self._expect = "colon"
+                    elif self._depth == 1 and self._expect == "value":
+                        self._complete(i + 1, completed)
+                continue
+
+            if c.isspace():
+                continue
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect in ("key", "value"):
+                    self._token_start = i
+                continue
+
+            if self._expect == "object":
+                if c == "{":
+                    self._depth = 1
+                    self._expect = "key"
+                continue  # text before the object, e.g., a markdown fence
+
+            if c in "{[":
+                if self._depth == 1 and self._expect == "value":
+                    self._token_start = i
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._expect == "value":
+                    self._complete(i + 1, completed)
+                elif self._depth == 0:
+                    if self._expect == "value" and self._token_start is not None:
+                        self._complete(i, completed)
+                    self.done = True
+            elif self._depth == 1:
+                if c == ":" and self._expect == "colon":
+                    self._expect = "value"
+                    self._token_start = None
+                elif c == ",":
+                    if self._expect == "value" and self._token_start is not None:
+                        self._complete(i, completed)
+                    self._expect = "key"
+                elif self._expect == "value" and self._token_start is None:
+                    self._token_start = i  # a number, true, false or null
+        return completed
+
+    def _complete(self, end: int, completed: Dict[str, Any]):
+        raw = self.text[self._token_start : end].strip()
+        self._token_start = None
+        self._expect = "delimiter"
+        try:
+            value = json.loads(raw, strict=False)
+        except json.JSONDecodeError:
+            self.errors.append(f"$.{self._key}: invalid value {raw!r}")
+            return
+        sub = self.schema.get("properties", {}).get(self._key)
+        if sub is not None:
+            errors = validate(value, sub, f"$.{self._key}")
+            if errors:
+                self.errors.extend(errors)
+                return
+        self.fields[self._key] = value
+        completed[self._key] = value
+        if self.on_field is not None:
+            self.on_field(self._key, value)
+
+    def result(self) -> Dict[str, Any]:
+        """The parsed object, raises ValueError if it is incomplete or does not match the schema."""
+        if not self.done:
+            raise ValueError("Incomplete JSON output")
+        if self.errors:
+            raise ValueError(f"Invalid JSON output: {self.errors}")
+        errors = validate(self.fields, self.schema)
+        if errors:
+            raise ValueError(f"Invalid JSON output: {errors}")
+        return self.fields
@@ -0,0 +1,175 @@
+# ------------------------------------------------------------------------------
+# File: metrics.py
+# Description: per-stage timing and llama.cpp token throughput of KriRAG runs
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+# summed per stage in the summary, from llama.cpp `timings` for LLM calls
+SUMMED_FIELDS = ["seconds", "items", "prompt_tokens", "prompt_ms", "generated_tokens", "generation_ms"]
+
+
+class Metrics:
+    """
+    Timed events of a run, one per stage execution (ingest, embedding, retrieval, LLM calls, ...).
+    Events are kept in memory until `attach` is called with the run's metrics file,
+    after which they are appended to it as they happen. Per-stage totals are kept for the summary.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events: List[Dict[str, Any]] = []
+        self.totals: Dict[str, Dict[str, float]] = {}
+        self._file = None
+
+    def attach(self, path: str):
+        """Write the events so far, and every following event, to a JSONL file."""
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(path, "a", encoding="utf-8")
+            for event in self.events:
+                self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._file.flush()
+            self.events = []
+
+    def record(self, stage: str, seconds: float, **fields):
+        event = {"time": time.time(), "stage": stage, "seconds": round(seconds, 4), **fields}
+        with self.lock:
+            totals = self.totals.setdefault(stage, {"count": 0, "cached": 0})
+            totals["count"] += 1
+            totals["cached"] += int(bool(fields.get("cached")))
+            for key in SUMMED_FIELDS:
+                if key in event and not fields.get("cached"):
+                    totals[key] = totals.get(key, 0) + event[key]
+            if self._file is not None and not self._file.closed:
+                self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+                self._file.flush()
+            else:
+                self.events.append(event)
+
+    @contextmanager
+    def stage(self, name: str, **fields):
+        """Time a block as one event of stage `name`. Fields can be added to the yielded dict."""
+        start = time.perf_counter()
+        extra = dict(fields)
+        try:
+            yield extra
+        finally:
+            self.record(name, time.perf_counter() - start, **extra)
+
+    def timed_iter(self, name: str, iterable: Iterable) -> Iterator:
+        """Yield from `iterable`, recording the time spent producing its items as one event."""
+        seconds = 0.0
+        n = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += time.perf_counter() - start
+                    break
+                seconds += time.perf_counter() - start
+                n += 1
+                yield item
+        finally:
+            self.record(name, seconds, items=n)
+
+    def record_llm(self, stage: str, seconds: float, timings: Optional[dict], cached: bool = False):
+        """An LLM call, with the token counts and durations reported by llama.cpp."""
+        fields: Dict[str, Any] = {"cached": cached}
+        if timings:
+            fields.update(
+                prompt_tokens=timings.get("prompt_n", 0),
+                prompt_ms=timings.get("prompt_ms", 0.0),
+                generated_tokens=timings.get("predicted_n", 0),
+                generation_ms=timings.get("predicted_ms", 0.0),
+            )
+        self.record(stage, seconds, **fields)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """One row per stage: calls, wall time, and for LLM stages tokens and throughput (uncached calls)."""
+        rows = []
+        with self.lock:
+            totals = {k: dict(v) for k, v in self.totals.items()}
+        for stage, t in totals.items():
+            row = {
+                "stage": stage,
+                "calls": t["count"],
+                "cached": t["cached"],
+                "seconds": round(t.get("seconds", 0.0), 2),
+                "mean_seconds": round(t.get("seconds", 0.0) / max(t["count"] - t["cached"], 1), 3),
+            }
+            if "items" in t:
+                row["items"] = t["items"]
+            if "prompt_tokens" in t:
+                row.update(
+                    prompt_tokens=t["prompt_tokens"],
+                    generated_tokens=t.get("generated_tokens", 0),
+                    prompt_ms=round(t.get("prompt_ms", 0.0)),
+                    prompt_tps=round(t["prompt_tokens"] / max(t.get("prompt_ms", 0.0), 1e-9) * 1000, 1),
+                    generation_tps=round(
+                        t.get("generated_tokens", 0) / max(t.get("generation_ms", 0.0), 1e-9) * 1000, 1
+                    ),
+                )
+            rows.append(row)
+        return rows
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+
+
+def format_summary(rows: List[Dict[str, Any]]) -> str:
+    """The summary as a plain-text table."""
+    if not rows:
+        return ""
+    columns = list(dict.fromkeys(k for row in rows for k in row))
+    cells = [[str(row.get(c, "")) for c in columns] for row in rows]
+    widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines += ["  ".join(v.ljust(w) for v, w in zip(r, widths)) for r in cells]
+    return "\n".join(lines)
+
+
+# the metrics of the run of each thread: runs of several (streamlit) sessions share the process,
+# so a run binds its metrics to its thread, and to the worker threads of its pools (as their initializer)
+_local = threading.local()
+# recorded into by threads without a run, e.g., when the modules are used as a library
+_default: Optional[Metrics] = None
+_default_lock = threading.Lock()
+
+
+def set_metrics(metrics: Optional[Metrics]) -> Optional[Metrics]:
+    """
+    Record the events of this thread into `metrics`, e.g., a new Metrics() for each run.
+    Pools of a run pass it to their workers with `initializer=set_metrics, initargs=(get_metrics(),)`.
+    Metrics of other threads, i.e., other runs, are left as they are.
+    """
+    _local.metrics = metrics
+    return metrics
+
+
+def get_metrics() -> Metrics:
+    """The metrics of the run of this thread, or the process-wide default, started on first use."""
+    metrics = getattr(_local, "metrics", None)
+    if metrics is not None:
+        return metrics
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Metrics()
+        return _default
@@ -0,0 +1,151 @@
+# ------------------------------------------------------------------------------
+# File: progress.py
+# Description: progress callbacks for ingestion and RAG runs (console, streamlit)
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import time
+from contextlib import nullcontext
+from typing import Dict, Set, Tuple
+
+
+class ProgressCallback:
+    """
+    Receives progress from ingestion and RAG runs.
+    The base class ignores everything, subclass it to report progress elsewhere.
+    """
+
+    # progress is reported at most once per interval (seconds) and label, besides completion
+    min_interval: float = 0.0
+    _last_update: Dict[str, float] = None
+
+    def should_update(self, label: str, done: int, total: int) -> bool:
+        if self._last_update is None:
+            self._last_update = {}
+        now = time.monotonic()
+        if done < total and now - self._last_update.get(label, 0.0) < self.min_interval:
+            return False
+        self._last_update[label] = now
+        return True
+
+    def on_info(self, message: str):
+        pass
+
+    def on_progress(self, label: str, done: int, total: int):
+        pass
+
+    def on_query(self, query: str):
+        """A query is dispatched, all queries are dispatched before their results arrive."""
+        pass
+
+    def on_batch(self, record: dict):
+        """The record of a batch, as soon as it completes (in completion order, across queries)."""
+        pass
+
+    def on_record(self, record: dict):
+        """Every record of a run in query and document order, including those restored from a checkpoint."""
+        pass
+
+    _shown: Set[Tuple] = None
+
+    def first_time(self, record: dict) -> bool:
+        """True the first time a record is seen, e.g., not again in on_record after on_batch."""
+        if self._shown is None:
+            self._shown = set()
+        key = (record["query"], record["id"], record["batch"])
+        if key in self._shown:
+            return False
+        self._shown.add(key)
+        return True
+
+
+class ConsoleCallback(ProgressCallback):
+    min_interval = 1.0
+
+    def on_info(self, message: str):
+        print(message)
+
+    def on_progress(self, label: str, done: int, total: int):
+        if not self.should_update(label, done, total):
+            return
+        end = "\n" if done >= total else ""
+        print(f"\r{label} {done}/{total}", end=end, flush=True)
+
+    def on_query(self, query: str):
+        print(f"Processing query: {query}")
+
+    def on_batch(self, record: dict):
+        self.on_record(record)
+
+    def on_record(self, record: dict):
+        if not self.first_time(record):
+            return
+        llm_output = record["llm_output"]
+        print(
+            f"{record['id']} (batch {record['batch']}): relevance score {llm_output['score']}/3"
+        )
+
+
+class StreamlitCallback(ProgressCallback):
+    """Renders progress and results in the current streamlit page (call from the script thread only)."""
+
+    min_interval = 0.25
+
+    def __init__(self):
+        import streamlit as st
+
+        self.st = st
+        self.bars: Dict[str, object] = {}
+        self.queries: Dict[str, object] = {}  # a container per query, filled as its batches complete
+
+    def on_info(self, message: str):
+        self.st.info(message)
+
+    def on_progress(self, label: str, done: int, total: int):
+        if not self.should_update(label, done, total):
+            return
+        if label not in self.bars:
+            self.bars[label] = self.st.progress(0, text=label)
+        self.bars[label].progress(min(done / max(total, 1), 1.0), text=label)
+        if done >= total:
+            self.bars.pop(label).empty()
+
+    def on_query(self, query: str):
+        self.st.write(f"Processing query: {query}")
+        self.queries[query] = self.st.container()
+
+    def on_batch(self, record: dict):
+        self.on_record(record)
+
+    def on_record(self, record: dict):
+        if not self.first_time(record):
+            return
+        st = self.st
+        llm_output = record["llm_output"]
+        container = self.queries.get(record["query"])
+        with container if container is not None else nullcontext(), st.expander(
+            f"Results for {record['id']} (relevance score: {llm_output['score']}/3)"
+        ):
+            col1, col2 = st.columns(2)
+            with col1:
+                st.markdown(f"#### Query\n{record['query']}")
+                st.markdown(f"#### Generated questions")
+                for q in llm_output["questions"]:
+                    if "question" in q:
+                        st.markdown(f"- {q['question']}")
+                st.markdown(f"#### Summary\n{llm_output['summary']}")
+
+                st.markdown(f"#### Memory")
+                for _prev_info in record["memory"]:
+                    if len(_prev_info) > 3:
+                        st.markdown(f"- {_prev_info}")
+
+            with col2:
+                st.markdown(f"#### Full text")
+                st.write(record["text"])
+            st.divider()
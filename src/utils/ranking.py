@@ -0,0 +1,53 @@
+# ------------------------------------------------------------------------------
+# File: ranking.py
+# Description: document ranking from sentence hits for KriRAG
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+from typing import Dict, List, Tuple
+
+# per-document aggregation of sentence hits
+# "max": the most similar sentence, "sum": all matching sentences,
+# "rrf": reciprocal rank fusion over the sentence ranks (many high-ranked sentences win)
+DOCUMENT_AGGREGATIONS = ["max", "sum", "rrf"]
+RRF_K = 60
+# sentences fetched per requested document, documents often match with several sentences
+RANKING_OVERSAMPLE = 10
+
+
+def rank_documents(
+    hits: List[Tuple[str, float]], aggregation: str = "max", top_k: int = None
+) -> List[Tuple[str, float]]:
+    """
+    Aggregate (document, score) sentence hits, best first, into (document, score) pairs,
+    ranked by the aggregated score and cut to `top_k` documents.
+    """
+    if aggregation not in DOCUMENT_AGGREGATIONS:
+        raise ValueError(f"aggregation must be one of {DOCUMENT_AGGREGATIONS}")
+    scores: Dict[str, float] = {}
+    for rank, (document, score) in enumerate(hits, start=1):
+        if aggregation == "max":
+            scores[document] = max(scores.get(document, 0.0), score)
+        elif aggregation == "sum":
+            scores[document] = scores.get(document, 0.0) + score
+        else:
+            scores[document] = scores.get(document, 0.0) + 1.0 / (RRF_K + rank)
+    ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+    return ranked[:top_k] if top_k else ranked
+
+
+def fuse_rankings(
+    rankings: List[List[Tuple[str, float]]], top_k: int = None
+) -> List[Tuple[str, float]]:
+    """Reciprocal rank fusion of document rankings, e.g., dense and lexical, as (document, score) pairs."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, (document, _) in enumerate(ranking, start=1):
+            scores[document] = scores.get(document, 0.0) + 1.0 / (RRF_K + rank)
+    ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+    return ranked[:top_k] if top_k else ranked
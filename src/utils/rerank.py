@@ -0,0 +1,54 @@
+# ------------------------------------------------------------------------------
+# File: rerank.py
+# Description: local cross-encoder reranker for the relevance pre-filter in KriRAG
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import os
+import threading
+from typing import TYPE_CHECKING, List
+
+if TYPE_CHECKING:
+    from sentence_transformers import CrossEncoder
+
+# a local cross-encoder, saved by install.py when RERANKER_SOURCE is set
+RERANKER_MODEL = os.getenv("RERANKER_MODEL", "reranker")
+RERANKER_BATCH_SIZE = int(os.getenv("RERANKER_BATCH_SIZE", 32))
+
+_reranker: "CrossEncoder" = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> "CrossEncoder":
+    """The process-wide cross-encoder, loaded on the first call."""
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            if not os.path.exists(RERANKER_MODEL):
+                raise ValueError(
+                    f"No reranker model at {RERANKER_MODEL}, set RERANKER_SOURCE and run install.py"
+                )
+            from sentence_transformers import CrossEncoder
+
+            print("Loading CrossEncoder model...")
+            _reranker = CrossEncoder(RERANKER_MODEL, local_files_only=True)
+        return _reranker
+
+
+def rerank_score(query: str, sentences: List[str]) -> float:
+    """
+    Relevance (0-1) of a batch of sentences to a query: the best sentence score.
+    Sentences are scored one by one, as batches are longer than the reranker input.
+    Single-label cross-encoders already apply a sigmoid in `predict`, so scores are probabilities.
+    """
+    if not sentences:
+        return 0.0
+    scores = get_reranker().predict(
+        [(query, s) for s in sentences], batch_size=RERANKER_BATCH_SIZE
+    )
+    return max(float(s) for s in scores)
@@ -0,0 +1,92 @@
+# ------------------------------------------------------------------------------
+# File: store.py
+# Description: document-level access to the sentences stored in ChromaDB
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+#
+# Contributors:
+# - Tollef Jørgensen (Initial Development, 2024)
+# ------------------------------------------------------------------------------
+
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from chromadb import Collection
+
+from utils.chroma import build_document_index, read_document_index, write_document_index
+
+
+class DocumentStore:
+    """
+    Document-level view of a sentence collection.
+    Sentences are fetched for many documents in a single `get` and cached for the lifetime of the store,
+    and document names are read from the index in the collection metadata rather than a full scan.
+    Documents are reconstructed in (page_id, sent_id) order, independent of the order Chroma returns them in.
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+        self._index: Optional[Dict[str, dict]] = None
+        self._sentences: Dict[str, List[str]] = {}
+        self.lock = threading.Lock()
+
+    def index(self) -> Dict[str, dict]:
+        if self._index is None:
+            index = read_document_index(self.collection)
+            if index is None:
+                # collections populated before the index existed: build it once
+                metadata = self.collection.get(include=["metadatas"])["metadatas"]
+                metadata = sorted(
+                    metadata, key=lambda m: (m["document"], m["page_id"], m["sent_id"])
+                )
+                index = build_document_index(
+                    [
+                        {"id": m["document"], "page_id": m["page_id"], "sent_id": m["sent_id"]}
+                        for m in metadata
+                    ]
+                )
+                write_document_index(self.collection, index)
+            self._index = index
+        return self._index
+
+    def names(self) -> List[str]:
+        return sorted(self.index().keys())
+
+    def get_page_spans(self, document: str) -> List[Tuple[int, int, int]]:
+        """(page_id, start, end) sentence offsets of each page in a document."""
+        entry = self.index().get(document, {})
+        pages = entry.get("pages", [])
+        spans = []
+        for i, (page_id, start) in enumerate(pages):
+            end = pages[i + 1][1] if i + 1 < len(pages) else entry["sentences"]
+            spans.append((page_id, start, end))
+        return spans
+
+    def get_sentences(self, documents: List[str]) -> Dict[str, List[str]]:
+        """
+        Sentences of each document in reading order, fetching all uncached documents in one round trip.
+        sent_id is the position of a sentence within its document, so each sentence
+        is placed directly in its slot of the document, without sorting.
+        """
+        with self.lock:
+            missing = [d for d in dict.fromkeys(documents) if d not in self._sentences]
+            if missing:
+                index = self.index()
+                result = self.collection.get(
+                    where={"document": {"$in": missing}},
+                    include=["documents", "metadatas"],
+                )
+                slots: Dict[str, list] = {
+                    d: [None] * index.get(d, {}).get("sentences", 0) for d in missing
+                }
+                for text, meta in zip(result["documents"], result["metadatas"]):
+                    doc_slots = slots[meta["document"]]
+                    sent_id = meta["sent_id"]
+                    if sent_id >= len(doc_slots):
+                        # stale index, grow the document
+                        doc_slots.extend([None] * (sent_id + 1 - len(doc_slots)))
+                    doc_slots[sent_id] = text
+                for d in missing:
+                    self._sentences[d] = [t for t in slots[d] if t is not None]
+            return {d: self._sentences[d] for d in documents}